@@ -0,0 +1,56 @@
+'''
+Christian Bunker
+M^2QM at UF
+October 2026
+
+Benchmarks of the scattering kernels in transport/wfm and transport/bardeen,
+timed across system size N and number of local dofs n_loc_dof, with peak
+memory and agreement with the dense reference recorded for each case
+
+Run from the top of the repo as
+    python -m benchmarks [--quick] [--only wfm bardeen] [--out bench.json]
+and compare the json files of two commits to see regressions and speedups
+'''
+
+import numpy as np
+
+import time
+import tracemalloc
+
+def measure(func, *args, repeat = 3, **kwargs) -> dict:
+    '''
+    Time func(*args, **kwargs), best of repeat calls, and its peak memory
+    (as traced by tracemalloc, which numpy reports its arrays to) in a
+    separate call after them, so that tracing does not slow down the timing
+    and imports done on the first call are not counted
+
+    returns dict of time (s), peak_MB, the output of the last call, and the
+    error message if func raised
+    '''
+    record = {"time": None, "peak_MB": None, "out": None, "exception": None};
+    try:
+        times = [];
+        for _ in range(repeat):
+            start = time.perf_counter();
+            record["out"] = func(*args, **kwargs);
+            times.append(time.perf_counter()-start);
+        record["time"] = min(times);
+        tracemalloc.start();
+        func(*args, **kwargs);
+        _, peak = tracemalloc.get_traced_memory();
+        tracemalloc.stop();
+        record["peak_MB"] = peak/1e6;
+    except Exception as e:
+        if(tracemalloc.is_tracing()): tracemalloc.stop();
+        record["exception"] = type(e).__name__+": "+str(e);
+    return record;
+
+def max_diff(out, ref) -> float:
+    '''
+    Largest absolute difference between two outputs (arrays or tuples of
+    arrays), or None if either is missing
+    '''
+    if(out is None or ref is None): return None;
+    if(isinstance(out, tuple)):
+        return max([max_diff(outi, refi) for outi, refi in zip(out, ref)]);
+    return float(np.max(abs(np.asarray(out) - np.asarray(ref))));
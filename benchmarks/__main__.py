@@ -0,0 +1,55 @@
+'''
+python -m benchmarks [--quick] [--only wfm bardeen] [--out bench.json]
+'''
+
+import numpy as np
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser(prog = "python -m benchmarks", description = "Time the wfm and bardeen kernels and write the records to json");
+parser.add_argument("--quick", action = "store_true", help = "small sizes only, as a smoke test");
+parser.add_argument("--only", nargs = "+", choices = ["wfm", "bardeen"], default = ["wfm", "bardeen"]);
+parser.add_argument("--out", type = str, default = "bench.json");
+parser.add_argument("--repeat", type = int, default = 3);
+parser.add_argument("--verbose", type = int, default = 1);
+args = parser.parse_args();
+
+# sizes
+if(args.quick):
+    wfm_Ns, wfm_n_loc_dofs = [10, 100], [2, 8];
+    bardeen_Ns, bardeen_n_loc_dofs = [5, 10], [2];
+else:
+    wfm_Ns, wfm_n_loc_dofs = [10, 100, 1000, 10000], [2, 8, 32];
+    bardeen_Ns, bardeen_n_loc_dofs = [5, 10, 20, 100, 1000], [2, 4];
+Es = np.linspace(-1.5, 1.5, 8);
+
+records = [];
+if("wfm" in args.only):
+    from benchmarks import bench_wfm
+    records += bench_wfm.run(wfm_Ns, wfm_n_loc_dofs, Es, repeat = args.repeat, verbose = args.verbose);
+if("bardeen" in args.only):
+    from benchmarks import bench_bardeen
+    records += bench_bardeen.run(bardeen_Ns, bardeen_n_loc_dofs, repeat = args.repeat, verbose = args.verbose);
+
+# where and when these were run
+try:
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True, check = True).stdout.strip();
+except (OSError, subprocess.CalledProcessError):
+    commit = None;
+meta = {"commit" : commit, "timestamp" : datetime.datetime.now().isoformat(),
+        "python" : sys.version.split()[0], "numpy" : np.__version__,
+        "platform" : platform.platform(), "cpu_count" : os.cpu_count()};
+
+with open(args.out, "w") as f:
+    json.dump({"meta" : meta, "records" : records}, f, indent = 1);
+if(args.verbose):
+    for rec in records:
+        print("{:<26} {:<7} N = {:<6} n = {:<3} {}".format(rec["func"], rec["solver"], rec["N"], rec["n_loc_dof"],
+            rec["exception"] if rec["exception"] else "{:.3e} s, {:.2f} MB, max diff = {}".format(rec["time"], rec["peak_MB"], rec["max_diff"])));
+    print("wrote "+args.out);
@@ -0,0 +1,72 @@
+'''
+Benchmarks of bardeen.Hsysmat and the bardeen.kernel_well, kernel_well_prime kernels
+'''
+
+from transport import bardeen
+from benchmarks import measure, max_diff
+
+import numpy as np
+
+def well_system(N, n_loc_dof, Ninfty = 5) -> dict:
+    '''
+    Args of the bardeen kernels for left and right wells of N sites around a
+    single central site, whose on site block flips neighboring local dofs.
+    A small splitting between local dofs keeps the eigenstates of the
+    alpha conserving parts labeled by alpha
+    '''
+    tLR = 1.0*np.eye(n_loc_dof);
+    split = 0.01*np.diagflat(np.arange(n_loc_dof));
+    HC = np.zeros((1,1,n_loc_dof,n_loc_dof), dtype = complex);
+    HC[0,0] = 0.4*tLR + split + 0.05*(np.eye(n_loc_dof, k=1) + np.eye(n_loc_dof, k=-1));
+    HCobs = np.zeros_like(HC);
+    HCobs[0,0] = np.diagflat(np.diagonal(HC[0,0]));
+    return dict(tinfty = 1.0*tLR, tL = tLR, tR = tLR,
+                Vinfty = 0.5*tLR + split, VL = split, VLprime = 0.5*tLR + split, VR = split, VRprime = 0.5*tLR + split,
+                Ninfty = Ninfty, NL = N, NR = N, HC = HC, HCobs = HCobs,
+                defines_Sz = np.diagflat(np.arange(n_loc_dof, dtype = float)), E_cutoff = 0.4*tLR);
+
+def run(Ns, n_loc_dofs, dense_max = 4000, kernel_max = 200, repeat = 3, verbose = 0) -> list:
+    '''
+    Time bardeen.Hsysmat, dense and sparse, and the bardeen.kernel_well and
+    bardeen.kernel_well_prime kernels, with dense and sparse hamiltonians, at
+    every N and n_loc_dof.
+    The dense paths are the reference for agreement, and are only run when the
+    dense system is at most dense_max (kernel_max for the kernels, whose cost
+    grows as a high power of the system size)
+
+    returns list of dict records
+    '''
+    records = [];
+    for N in Ns:
+        for n_loc_dof in n_loc_dofs:
+            args = well_system(N, n_loc_dof);
+            size = (2*args["Ninfty"]+2*N+1)*n_loc_dof;
+            case = {"N" : N, "n_loc_dof" : n_loc_dof};
+
+            # hamiltonian, dense reference first
+            Hargs = [args[key] for key in ["tinfty", "tL", "tR", "Vinfty", "VL", "VR", "Ninfty", "NL", "NR", "HC"]];
+            ref = None;
+            if(size <= dense_max):
+                rec = measure(bardeen.Hsysmat, *Hargs, repeat = repeat);
+                ref = bardeen.ham_2d(rec["out"]) if rec["out"] is not None else None;
+                records.append(dict(func = "bardeen.Hsysmat", solver = "dense", **case, time = rec["time"], peak_MB = rec["peak_MB"], max_diff = 0.0 if ref is not None else None, exception = rec["exception"]));
+            rec = measure(bardeen.Hsysmat, *Hargs, is_sparse = True, repeat = repeat);
+            out = rec["out"].toarray() if (rec["out"] is not None and ref is not None) else None;
+            records.append(dict(func = "bardeen.Hsysmat", solver = "sparse", **case, time = rec["time"], peak_MB = rec["peak_MB"], max_diff = max_diff(out, ref), exception = rec["exception"]));
+
+            # kernels
+            common = [args[key] for key in ["tinfty", "tL", "tR", "Vinfty", "VL", "VLprime", "VR", "VRprime", "Ninfty", "NL", "NR", "HC"]];
+            # not kernel_well_super, which is unfinished and always asserts False
+            kernels = [("bardeen.kernel_well", bardeen.kernel_well, common + [args["HCobs"], args["defines_Sz"], args["E_cutoff"]]),
+                       ("bardeen.kernel_well_prime", bardeen.kernel_well_prime, common + [args["HCobs"], args["E_cutoff"]])];
+            for name, kernel, kernel_args in kernels:
+                ref = None;
+                if(size <= kernel_max):
+                    rec = measure(kernel, *kernel_args, repeat = 1);
+                    ref = rec["out"];
+                    records.append(dict(func = name, solver = "dense", **case, time = rec["time"], peak_MB = rec["peak_MB"], max_diff = 0.0 if ref is not None else None, exception = rec["exception"]));
+                if(size <= dense_max):
+                    rec = measure(kernel, *kernel_args, is_sparse = True, repeat = 1);
+                    records.append(dict(func = name, solver = "sparse", **case, time = rec["time"], peak_MB = rec["peak_MB"], max_diff = max_diff(rec["out"], ref), exception = rec["exception"]));
+            if(verbose): print(" - bardeen N = {:.0f}, n_loc_dof = {:.0f} done".format(N, n_loc_dof));
+    return records;
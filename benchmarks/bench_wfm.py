@@ -0,0 +1,59 @@
+'''
+Benchmarks of wfm.kernel (each solver) and wfm.Green
+'''
+
+from transport import wfm
+from benchmarks import measure, max_diff
+
+import numpy as np
+
+def random_system(N, n_loc_dof, seed = 0) -> tuple:
+    '''
+    h, tnn, tnnn for N sites of random hermitian on site blocks and nearly
+    uniform hopping, between leads with diagonal, zero on site blocks
+    '''
+    rng = np.random.default_rng(seed);
+    h = np.zeros((N+2, n_loc_dof, n_loc_dof), dtype = complex);
+    blocks = rng.normal(size = (N, n_loc_dof, n_loc_dof)) + complex(0,1)*rng.normal(size = (N, n_loc_dof, n_loc_dof));
+    h[1:-1] = 0.1*(blocks + np.conj(np.swapaxes(blocks, -2, -1)));
+    tnn = -np.tile(np.eye(n_loc_dof, dtype = complex), (N+1, 1, 1));
+    tnn[1:-1] += 0.05*rng.normal(size = (max(N-1, 0), n_loc_dof, n_loc_dof));
+    tnn = (tnn + np.swapaxes(tnn, -2, -1))/2; # Hmat puts tnn on both off diagonals
+    tnnn = np.zeros((N, n_loc_dof, n_loc_dof), dtype = complex);
+    return h, tnn, tnnn;
+
+def run(Ns, n_loc_dofs, Es, dense_max = 2000, repeat = 3, verbose = 0) -> list:
+    '''
+    Time wfm.kernel with each solver, and wfm.Green, at every N and n_loc_dof.
+    The dense solver is the reference for agreement, and is only run when
+    the dense matrix E - H' is at most dense_max x dense_max
+
+    returns list of dict records
+    '''
+    records = [];
+    for N in Ns:
+        for n_loc_dof in n_loc_dofs:
+            h, tnn, tnnn = random_system(N, n_loc_dof);
+            source = np.zeros(n_loc_dof);
+            source[0] = 1.0;
+            is_dense = ((N+2)*n_loc_dof <= dense_max);
+            case = {"N" : N, "n_loc_dof" : n_loc_dof, "n_E" : len(Es)};
+
+            # dense reference first
+            ref = None;
+            if(is_dense):
+                rec = measure(wfm.kernel, h, tnn, tnnn, 1.0, Es, source, False, False, solver = "dense", repeat = 1);
+                ref = rec["out"];
+                records.append(dict(func = "wfm.kernel", solver = "dense", **case, time = rec["time"], peak_MB = rec["peak_MB"], max_diff = 0.0 if ref is not None else None, exception = rec["exception"]));
+            for solver in ["rgf", "stream"]:
+                rec = measure(wfm.kernel, h, tnn, tnnn, 1.0, Es, source, False, False, solver = solver, repeat = repeat);
+                records.append(dict(func = "wfm.kernel", solver = solver, **case, time = rec["time"], peak_MB = rec["peak_MB"], max_diff = max_diff(rec["out"], ref), exception = rec["exception"]));
+
+            # full dense Green's function, against the RGF block column
+            if(is_dense):
+                rec = measure(wfm.Green, h, tnn, tnnn, 1.0, Es[0], repeat = 1);
+                Gcol = wfm.Green_RGF(h, tnn, tnnn, 1.0, Es[0], [0])[:,0];
+                diff = max_diff(rec["out"][:,0], Gcol) if rec["out"] is not None else None;
+                records.append(dict(func = "wfm.Green", solver = "dense", **dict(case, n_E = 1), time = rec["time"], peak_MB = rec["peak_MB"], max_diff = diff, exception = rec["exception"]));
+            if(verbose): print(" - wfm N = {:.0f}, n_loc_dof = {:.0f} done".format(N, n_loc_dof));
+    return records;
@@ -8,7 +8,7 @@ Want to make a SWAP gate
 solved in time-independent QM using wfm method in transport/wfm
 '''
 
-from transport import wfm, tdfci
+from transport import wfm, tdfci, spin_ops
 from transport.tdfci import utils
 
 import numpy as np
@@ -31,37 +31,14 @@ def h_cicc(TwoS, J, i1, i2, verbose=0) -> np.ndarray:
     NC = i2[-1]; # num sites in the central region
     mol_dof = (TwoS+1)*(TwoS+1);
     
-    # Sd ops 
-    TwoS_ladder = (2*np.arange(TwoS+1) -TwoS)[::-1];
-    Seye = np.eye(TwoS+1);
-    Sz = np.diagflat(0.5*TwoS_ladder)
-    Splus = np.diagflat(np.sqrt(0.5*TwoS*(0.5*TwoS+1)-0.5*TwoS_ladder[1:]*(0.5*TwoS_ladder[1:]+1)),k=1);
-    Sminus = np.diagflat(np.sqrt(0.5*TwoS*(0.5*TwoS+1)-0.5*TwoS_ladder[:-1]*(0.5*TwoS_ladder[:-1]-1)),k=-1);
+    # Sd ops, heisenberg interaction matrices (cached)
     if(verbose and TwoS > 1):
-        print("TwoS_ladder =\n",TwoS_ladder)
+        Sz, Splus, Sminus = spin_ops.spin_matrices(TwoS);
         print("Sz = \n",Sz)
         print("S+ = \n",Splus)
         print("S- = \n",Sminus)
-
-    
-    # heisenberg interaction matrices
-    Se_dot_S1_z = tdfci.utils.mat_4d_to_2d(np.tensordot(Sz, Seye, axes=0));
-    Se_dot_S1_z = tdfci.utils.mat_4d_to_2d(np.tensordot(np.array([[0.5,0],[0,-0.5]]), Se_dot_S1_z, axes=0));
-    Se_dot_S1_pm = tdfci.utils.mat_4d_to_2d(np.tensordot(Sminus, Seye, axes=0));
-    Se_dot_S1_pm = tdfci.utils.mat_4d_to_2d(np.tensordot(np.array([[0,1],[0,0]]), Se_dot_S1_pm, axes=0));
-    Se_dot_S1_mp = tdfci.utils.mat_4d_to_2d(np.tensordot(Splus, Seye, axes=0));
-    Se_dot_S1_mp = tdfci.utils.mat_4d_to_2d(np.tensordot(np.array([[0,0],[1,0]]), Se_dot_S1_mp, axes=0));
-    Se_dot_S1 = J*(Se_dot_S1_z + 0.5*(Se_dot_S1_pm + Se_dot_S1_mp));
-    Se_dot_S2_z = tdfci.utils.mat_4d_to_2d(np.tensordot(Seye, Sz, axes=0));
-    Se_dot_S2_z = tdfci.utils.mat_4d_to_2d(np.tensordot(np.array([[0.5,0],[0,-0.5]]), Se_dot_S2_z, axes=0));
-    Se_dot_S2_pm = tdfci.utils.mat_4d_to_2d(np.tensordot(Seye, Sminus, axes=0));
-    Se_dot_S2_pm = tdfci.utils.mat_4d_to_2d(np.tensordot(np.array([[0,1],[0,0]]), Se_dot_S2_pm, axes=0));
-    Se_dot_S2_mp = tdfci.utils.mat_4d_to_2d(np.tensordot(Seye, Splus, axes=0));
-    Se_dot_S2_mp = tdfci.utils.mat_4d_to_2d(np.tensordot(np.array([[0,0],[1,0]]), Se_dot_S2_mp, axes=0));
-    Se_dot_S2 = J*(Se_dot_S2_z + 0.5*(Se_dot_S2_pm + Se_dot_S2_mp));
-    #print(Se_dot_S1);
-    #print(Se_dot_S2);
-    #assert False
+    Se_dot_S1 = J*spin_ops.exchange(TwoS, 2, 0);
+    Se_dot_S2 = J*spin_ops.exchange(TwoS, 2, 1);
 
     # insert these local interactions
     h_cicc =[];
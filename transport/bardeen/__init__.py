@@ -6,7 +6,8 @@ November 2022
 Bardeen tunneling theory in 1D
 '''
 
-from transport import fci_mod, wfm
+from transport import wfm
+from transport.tdfci import utils as fci_mod
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -17,7 +18,7 @@ import matplotlib.pyplot as plt
 def kernel_well(tinfty, tL, tR,
            Vinfty, VL, VLprime, VR, VRprime,
            Ninfty, NL, NR, HC, HCobs, defines_Sz,
-            E_cutoff, interval=1e-12, expval_tol=1e-12, verbose=0) -> tuple:
+            E_cutoff, interval=1e-12, expval_tol=1e-12, is_sparse=False, cache=None, verbose=0) -> tuple:
     '''
     Calculate the Oppenheimer matrix elements M_nm averaged over n in a
     nearby interval. NB the eigenstates of HL/HR, and thus the Oppenheimer
@@ -62,6 +63,11 @@ def kernel_well(tinfty, tL, tR,
     expval_tol: tolerance for classifying eigenstates of HLobs based on
     their expectation values of the defines_Sz operator 
 
+    is_sparse: whether to build the hamiltonians as scipy.sparse matrices
+    (see Hsysmat) and diagonalize them without densifying
+
+    cache: EigenCache of eigenstates of HL, HR etc, shared between calls
+
     Returns:
     -Emas, complex 2d array, initial energies separated by spin and energy
     - Mbmas_eff, real 3d array, NORM SQUARED of EFFECTIVE Oppenheimer
@@ -86,25 +92,25 @@ def kernel_well(tinfty, tL, tR,
     tLa, tRa = tuple(converted);
 
     # physical system
-    Hsys_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VR, Ninfty, NL, NR, HC);
+    Hsys_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VR, Ninfty, NL, NR, HC, is_sparse=is_sparse);
     
     # left lead bound states, energy is only good quantum number
-    HL_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VRprime, Ninfty, NL, NR, HC);
-    Ems, psims = get_mstates(HL_4d, tLa, verbose=verbose);
+    HL_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VRprime, Ninfty, NL, NR, HC, is_sparse=is_sparse);
+    Ems, psims = cached(cache, get_mstates, HL_4d, tLa, verbose=verbose);
 
     # left lead observable basis, where Sz is a good quantum number
-    HLobs_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VRprime, Ninfty, NL, NR, HCobs);
-    assert(is_alpha_conserving(fci_mod.mat_4d_to_2d(HLobs_4d),n_loc_dof));
-    Emus, psimus = get_mstates(HLobs_4d, tLa, verbose=verbose);
+    HLobs_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VRprime, Ninfty, NL, NR, HCobs, is_sparse=is_sparse);
+    assert(is_alpha_conserving(ham_2d(HLobs_4d),n_loc_dof));
+    Emus, psimus = cached(cache, get_mstates, HLobs_4d, tLa, verbose=verbose);
 
     # right lead bound states, energy is only good quantum number
-    HR_4d = Hsysmat(tinfty, tL, tR, Vinfty, VLprime, VR, Ninfty, NL, NR, HC);
-    Ens, psins = get_mstates(HR_4d, tRa, verbose=verbose);
+    HR_4d = Hsysmat(tinfty, tL, tR, Vinfty, VLprime, VR, Ninfty, NL, NR, HC, is_sparse=is_sparse);
+    Ens, psins = cached(cache, get_mstates, HR_4d, tRa, verbose=verbose);
 
     # right lead observable basis, where Sz is a good quantum number
-    HRobs_4d = Hsysmat(tinfty, tL, tR, Vinfty, VLprime, VR, Ninfty, NL, NR, HCobs);
-    assert(is_alpha_conserving(fci_mod.mat_4d_to_2d(HRobs_4d),n_loc_dof));
-    Enus, psinus = get_mstates(HRobs_4d, tRa, verbose=verbose);
+    HRobs_4d = Hsysmat(tinfty, tL, tR, Vinfty, VLprime, VR, Ninfty, NL, NR, HCobs, is_sparse=is_sparse);
+    assert(is_alpha_conserving(ham_2d(HRobs_4d),n_loc_dof));
+    Enus, psinus = cached(cache, get_mstates, HRobs_4d, tRa, verbose=verbose);
 
     if(verbose > 9): # plot wfs
         #plot_ham((Hsys_4d,), ["$H_{sys}$"], 0 );
@@ -119,35 +125,14 @@ def kernel_well(tinfty, tL, tR,
     # average matrix elements over final states |k_n >
     # with the energy sufficiently close to that of the
     # initial state |k_m \alpha>
-    Hdiff = fci_mod.mat_4d_to_2d(Hsys_4d - HL_4d);
-    Mms = np.empty_like(Ems);
-    # initial energy and spin states
-    for m in range(np.shape(Ems)[-1]):               
-        # inelastic means averaging over an energy interval
-        Mns = [];
-        for n in range(np.shape(Ens)[-1]):
-            if( abs(Ems[m] - Ens[n]) < interval):
-                melement = np.dot(np.conj(psins[n]), np.matmul(Hdiff, psims[m]));
-                if(np.real(melement) < 0):
-                    if(verbose>5): print("\tWARNING: changing sign of melement");
-                    melement *= (-1);
-                Mns.append(melement);
-
-        # "adaptive" interval 
-        if( np.isnan(interval) and Mns==[]): 
-            n_nearest = np.argmin( abs(Ems[m] - Ens) );
-            melement = np.dot(np.conj(psins[n_nearest]), np.matmul(Hdiff, psims[m]));
-            if(np.real(melement) < 0):
-                if(verbose>5): print("\tWARNING: changing sign of melement");
-                melement *= (-1);
-            Mns.append(melement);
-
-        # update M with average
-        if(verbose): print("\tinterval = ",interval, len(Mns));
-        #if(len(Mns) not in [0,1]): raise Exception("This destroys final state spin information");
-        if Mns: Mns = sum(Mns)/len(Mns);
-        else: Mns = 0.0;
-        Mms[m] = Mns;
+    # one product on the sites where Hsys and HL differ, for all m and n. These are
+    # HC and, since VR != VRprime, the whole right well
+    Hdiff = ham_2d(Hsys_4d - HL_4d);
+    Mnms = matrix_elements(psins, Hdiff, psims, n_loc_dof);
+    if(verbose>5 and np.any(np.real(Mnms) < 0)): print("\tWARNING: changing sign of melement");
+    Mnms = np.where(np.real(Mnms) < 0, -Mnms, Mnms);
+    Mms = average_final(Mnms, Ems[None,:], Ens[:,None], interval, axis=0, verbose=verbose);
+    del Mnms;
 
     ####
     #### averaging must be done in eigenbasis of system (ie above)
@@ -158,10 +143,7 @@ def kernel_well(tinfty, tL, tR,
 
     # change of basis matrix from psims to psi_mus (for observables)
     # st psi_mu = \sum_m change_basis[m, \mu] \psi_m
-    change_basis = np.empty((np.shape(Ems)[-1], np.shape(Emus)[-1]),dtype=complex);
-    for m in range(np.shape(Ems)[-1]):
-        for mu in range(np.shape(Emus)[-1]):
-            change_basis[m, mu] = np.dot( np.conj(psims[m]), psimus[mu]);
+    change_basis = np.conj(psims) @ psimus.T;
             
     # get effective matrix elements by changing basis
     Mnumus = np.matmul( np.conj(change_basis.T), np.matmul(Mnms, change_basis) );
@@ -182,84 +164,48 @@ def kernel_well(tinfty, tL, tR,
     Mnumus = Mnumus[:(nu_cutoff//n_loc_dof)*n_loc_dof,:(mu_cutoff//n_loc_dof)*n_loc_dof];
     
     # classify the psi_mus and psi_nus by \sigma_z, and likewise break up M nu mus
-    E_mualphas = np.zeros((n_loc_dof,len(Emus)),dtype=complex);
-    psi_mualphas = np.zeros((n_loc_dof,len(Emus),len(psimus[0])),dtype=complex);
-    E_nubetas = np.zeros((n_loc_dof,len(Enus)),dtype=complex);
-    psi_nubetas = np.zeros((n_loc_dof,len(Enus),len(psinus[0])),dtype=complex);
-    M_betanu_alphamus = np.empty((n_loc_dof,len(Enus),n_loc_dof,len(Emus)),dtype=float);
-
-    # need to take exp vals of Sz to do this
+    # need to take exp vals of Sz to do this, site by site
     expvals_exact, _ = np.linalg.eigh(defines_Sz);
     print("expvals_exact = ", expvals_exact);
-    defines_Sz_4d = np.zeros((n_spatial_dof, n_spatial_dof, n_loc_dof, n_loc_dof),dtype=complex);
-    for sitej in range(n_spatial_dof):
-        defines_Sz_4d[sitej,sitej] = np.copy(defines_Sz);
-    defines_Sz_2d = fci_mod.mat_4d_to_2d(defines_Sz_4d);
-
-    # classify mu states
-    mucounter = np.zeros((n_loc_dof,),dtype = int);
-    for mu in range(np.shape(Emus)[-1]):
-        expSz_mu = np.dot( np.conj(psimus[mu]), np.dot(defines_Sz_2d, psimus[mu]));
-        Sz_index_mu = 2;
-        for expvali_mu in range(n_loc_dof):
-            if(abs(expSz_mu-expvals_exact[expvali_mu])<expval_tol):                
-                Sz_index_mu = expvali_mu;
-                E_mualphas[Sz_index_mu,mucounter[Sz_index_mu]] = Emus[mu];
-                psi_mualphas[Sz_index_mu,mucounter[Sz_index_mu]] = psimus[mu];
-                mucounter[Sz_index_mu] += 1;                                
-        if(Sz_index_mu not in np.array(range(n_loc_dof))): raise Exception("<Sz>_mu = "+str(expSz_mu)+" not an eigenval of Sz");
-        # classify nu states
-        nucounter = np.zeros((n_loc_dof,),dtype = int);
-        for nu in range(np.shape(Enus)[-1]):
-            expSz_nu = np.dot( np.conj(psinus[nu]), np.dot(defines_Sz_2d, psinus[nu]));
-            Sz_index_nu = 2;
-            for expvali_nu in range(n_loc_dof):
-                if(abs(expSz_nu-expvals_exact[expvali_nu])<expval_tol):
-                    Sz_index_nu = expvali_nu;
-                    E_nubetas[Sz_index_nu,nucounter[Sz_index_nu]] = Enus[nu];
-                    psi_nubetas[Sz_index_nu,nucounter[Sz_index_nu]] = psinus[nu];
-                    nucounter[Sz_index_nu] += 1;
-            if(Sz_index_nu not in np.array(range(n_loc_dof))): raise Exception("<Sz>_nu = "+str(expSz_nu)+" not an eigenval of Sz");
-             # classify M nu mus
-            M_betanu_alphamus[Sz_index_nu,nucounter[Sz_index_nu]-1,Sz_index_mu,mucounter[Sz_index_mu]-1] = Mnumus[nu,mu];
+    Sz_index_mus, mu_ranks = classify_expvals(site_expvals(psimus, defines_Sz), expvals_exact, expval_tol, "mu");
+    Sz_index_nus, nu_ranks = classify_expvals(site_expvals(psinus, defines_Sz), expvals_exact, expval_tol, "nu");
+    mucounter = np.bincount(Sz_index_mus, minlength = n_loc_dof);
+    nucounter = np.bincount(Sz_index_nus, minlength = n_loc_dof);
+    E_mualphas = np.zeros((n_loc_dof,len(Emus)),dtype=complex);
+    psi_mualphas = np.zeros((n_loc_dof,len(Emus),n_spatial_dof*n_loc_dof),dtype=complex);
+    E_mualphas[Sz_index_mus, mu_ranks] = Emus;
+    psi_mualphas[Sz_index_mus, mu_ranks] = psimus;
+    E_nubetas = np.zeros((n_loc_dof,len(Enus)),dtype=complex);
+    E_nubetas[Sz_index_nus, nu_ranks] = Enus;
+    M_betanu_alphamus = np.zeros((n_loc_dof,len(Enus),n_loc_dof,len(Emus)),dtype=float);
+    M_betanu_alphamus[Sz_index_nus[:,None], nu_ranks[:,None], Sz_index_mus[None,:], mu_ranks[None,:]] = Mnumus;
     del Emus, psimus, Enus, psinus, Mnumus;
 
     # truncate again
-    E_mualphas_trunc = np.empty((n_loc_dof,np.min(mucounter)),dtype=complex);
-    E_nubetas_trunc = np.empty((n_loc_dof,np.min(nucounter)),dtype=complex);
-    Mnbmas_eff = np.empty((n_loc_dof,np.min(nucounter),n_loc_dof,np.min(mucounter)),dtype=float);
-    for alpha in range(n_loc_dof):
-        E_mualphas_trunc[alpha,:] = E_mualphas[alpha,:np.min(mucounter)];
-        for beta in range(n_loc_dof):
-            E_nubetas_trunc[beta,:] = E_nubetas[beta,:np.min(nucounter)];
-            Mnbmas_eff[alpha,:,beta,:] = M_betanu_alphamus[beta,:np.min(nucounter),alpha,:np.min(mucounter)];
+    E_mualphas_trunc = E_mualphas[:,:np.min(mucounter)];
+    E_nubetas_trunc = E_nubetas[:,:np.min(nucounter)];
+    Mnbmas_eff = np.transpose(M_betanu_alphamus[:,:np.min(nucounter),:,:np.min(mucounter)], (2,1,0,3));
     if(verbose > 9): # plot wfs
         print("E_mualphas = ", np.shape(E_mualphas),"\n",E_mualphas+2*tLa);
         print("E_mualphas_trunc = ", np.shape(E_mualphas_trunc),"\n",E_mualphas_trunc+2*tLa);
         for mymu in [18,19]:
             print("psi_mu = ",mymu);
-            expSz_mu_alpha0 = np.dot( np.conj(psi_mualphas[0,mymu]), np.dot(defines_Sz_2d, psi_mualphas[0,mymu]));
-            expSz_mu_alpha1 = np.dot( np.conj(psi_mualphas[1,mymu]), np.dot(defines_Sz_2d, psi_mualphas[1,mymu]));
-            print("<Sz> of alpha0 = ", expSz_mu_alpha0);
-            print("<Sz> of alpha1 = ", expSz_mu_alpha1);
+            print("<Sz> of alpha0 = ", site_expvals(psi_mualphas[0,mymu], defines_Sz));
+            print("<Sz> of alpha1 = ", site_expvals(psi_mualphas[1,mymu], defines_Sz));
             plot_wfs(HLobs_4d, psi_mualphas, E_mualphas_trunc, which_m = mymu);
         raise NotImplementedError;
     E_mualphas, E_nubetas = E_mualphas_trunc, E_nubetas_trunc;
     
     # get rid of nu as free index
     interval = np.nan
-    Mbmas_eff = np.empty((n_loc_dof,np.shape(E_mualphas)[-1],n_loc_dof),dtype=float);
-    for beta in range(n_loc_dof):
-        for alpha in range(n_loc_dof):
-            for mu in range(np.shape(E_mualphas)[-1]):
-                Mbmas_eff[beta,mu,alpha] = np.sum(Mnbmas_eff[beta,:,alpha,mu]);
+    Mbmas_eff = np.transpose(np.sum(Mnbmas_eff, axis=1), (0,2,1));
 
     return E_mualphas, Mbmas_eff;
 
 def kernel_well_super(tinfty, tL, tR,
            Vinfty, VL, VLprime, VR, VRprime,
            Ninfty, NL, NR, HC, HCprime, alpha_mat, E_cutoff,
-           interval=1e-9,expval_tol=1e-9,verbose=0) -> tuple:
+           interval=1e-9,expval_tol=1e-9,is_sparse=False,cache=None,verbose=0) -> tuple:
     '''
     Calculate the Oppenheimer matrix elements M_nbma averaged over n in a
     nearby interval
@@ -287,6 +233,9 @@ def kernel_well_super(tinfty, tL, tR,
         there will be some deviation of <k_m \alpha | alpha_mat | k_m \alpha>
         around its true value due to symmetry breaking. This is the allowed
         tolerance of such deviation
+    -is_sparse, whether to build the hamiltonians as scipy.sparse matrices
+        (see Hsysmat) and diagonalize them without densifying
+    -cache, EigenCache of eigenstates of HL and HR, shared between calls
 
     Returns:
     -Emas, complex 2d array, initial energies separated by spin and energy
@@ -324,15 +273,15 @@ def kernel_well_super(tinfty, tL, tR,
             change_basis[astatei, tstatei] = np.dot( np.conj(alphastates[astatei]), tildestates[tstatei]);
 
     # find left lead bound states, they will be in alpha basis
-    HL_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VRprime, Ninfty, NL, NR, HCprime);
-    Emas, psimas = get_bound_states(HL_4d, tLa, alpha_mat, E_cutoff, expval_tol = expval_tol, verbose=verbose);
+    HL_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VRprime, Ninfty, NL, NR, HCprime, is_sparse=is_sparse);
+    Emas, psimas = cached(cache, get_bound_states, HL_4d, tLa, alpha_mat, E_cutoff, expval_tol = expval_tol, verbose=verbose);
 
     # find right lead bound states, they will be in alpha basis
-    HR_4d = Hsysmat(tinfty, tL, tR, Vinfty, VLprime, VR, Ninfty, NL, NR, HCprime);
-    Enbs, psinbs = get_bound_states(HR_4d, tRa, alpha_mat, E_cutoff, expval_tol = expval_tol, verbose=verbose);
+    HR_4d = Hsysmat(tinfty, tL, tR, Vinfty, VLprime, VR, Ninfty, NL, NR, HCprime, is_sparse=is_sparse);
+    Enbs, psinbs = cached(cache, get_bound_states, HR_4d, tRa, alpha_mat, E_cutoff, expval_tol = expval_tol, verbose=verbose);
 
     # physical system
-    Hsys_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VR, Ninfty, NL, NR, HC);  
+    Hsys_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VR, Ninfty, NL, NR, HC, is_sparse=is_sparse);  
     if(verbose > 9): # plot wfs, hams
         plot_wfs(HL_4d, psimas, Emas, which_m = 13);
         plot_wfs(HR_4d, psinbs, Enbs, which_m = 13);
@@ -348,36 +297,15 @@ def kernel_well_super(tinfty, tL, tR,
     # with the energy sufficiently close to that of the
     # initial state |k_m \alpha>
     # keep spin separate
-    Hdiff = fci_mod.mat_4d_to_2d(Hsys_4d - HL_4d);
-    Mbmas = np.empty((n_loc_dof,np.shape(Emas)[-1],n_loc_dof),dtype=complex);
-    # initial energy and spin states
-    for alpha in range(n_loc_dof):
-        for m in range(np.shape(Emas)[-1]):               
-            for beta in range(n_loc_dof):
-                # inelastic means averaging over an enegy interval
-                Mns = [];
-                for n in range(np.shape(Enbs)[-1]):
-                    if( abs(Emas[alpha,m] - Enbs[beta,n]) < interval):
-                        melement = np.dot(np.conj(psinbs[beta,n]), np.matmul(Hdiff, psimas[alpha,m]));
-                        if(np.real(melement) < 0):
-                            if(verbose>5): print("\tWARNING: changing sign of melement");
-                            melement *= (-1);
-                        Mns.append(melement);
-
-                # "adaptive" interval 
-                if( np.isnan(interval) and Mns==[]): 
-                    n_nearest = np.argmin( abs(Emas[alpha,m] - Enbs[beta]) );
-                    melement = np.dot(np.conj(psinbs[beta,n_nearest]), np.matmul(Hdiff, psimas[alpha,m]));
-                    if(np.real(melement) < 0):
-                        if(verbose>5): print("\tWARNING: changing sign of melement");
-                        melement *= (-1);
-                    Mns.append(melement);
-
-                # update M with average
-                if(verbose): print("\tinterval = ",interval, len(Mns));
-                if Mns: Mns = sum(Mns)/len(Mns);
-                else: Mns = 0.0;
-                Mbmas[beta,m,alpha] = Mns;
+    # one product on the sites where Hsys and HL differ, for all m and n. These are
+    # HC and, since VR != VRprime, the whole right well
+    Hdiff = ham_2d(Hsys_4d - HL_4d);
+    Mbnams = matrix_elements(psinbs, Hdiff, psimas, n_loc_dof); # [beta,n,alpha,m]
+    if(verbose>5 and np.any(np.real(Mbnams) < 0)): print("\tWARNING: changing sign of melement");
+    Mbnams = np.where(np.real(Mbnams) < 0, -Mbnams, Mbnams);
+    Mambs = average_final(Mbnams, Emas[None,None,:,:], Enbs[:,:,None,None], interval, axis=1, verbose=verbose);
+    Mbmas = np.transpose(Mambs, (0,2,1)); # [beta,alpha,m] -> [beta,m,alpha]
+    del Mbnams, Mambs;
 
     # get effective matrix elements
     Mbmas_tilde = np.zeros_like(Mbmas);
@@ -400,7 +328,7 @@ def kernel_well_super(tinfty, tL, tR,
 def kernel_well_prime(tinfty, tL, tR,
            Vinfty, VL, VLprime, VR, VRprime,
            Ninfty, NL, NR, HC,HCprime,E_cutoff,
-           interval=1e-9,verbose=0) -> tuple:
+           interval=1e-9,is_sparse=False,cache=None,updater=None,verbose=0) -> tuple:
     '''
     Calculate the Oppenheimer matrix elements M_nbma averaged over final energy
     states n in aninterval close to the initial energy state m
@@ -417,6 +345,15 @@ def kernel_well_prime(tinfty, tL, tR,
 
     interval: rectangle func energy window, corresponding to 2\pi\hbar/t
 
+    is_sparse: whether to build the hamiltonians as scipy.sparse matrices
+    (see Hsysmat) and diagonalize them without densifying
+
+    cache: EigenCache of eigenstates of HL, HR etc, shared between calls
+
+    updater: EigenUpdater shared between calls, which finds the eigenstates
+    of HL, HR from those of an earlier call when only HCprime changed, or
+    every V by the same amount (eg Delta). Used instead of cache
+
     This kernel REQUIRES the eigenstates of HL/HR to be Sz eigenstates,
     and so CAN RESOLVE the spin -> spin transitions. It allows those
     transitions because Hsys-HL has a spin-flip term.
@@ -444,12 +381,15 @@ def kernel_well_prime(tinfty, tL, tR,
     tLa, tRa = tuple(converted);
 
     # left well eigenstates
-    HL_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VRprime, Ninfty, NL, NR, HCprime);
-    assert(is_alpha_conserving(fci_mod.mat_4d_to_2d(HL_4d),n_loc_dof));
+    HL_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VRprime, Ninfty, NL, NR, HCprime, is_sparse=is_sparse);
+    HL_2d = ham_2d(HL_4d);
+    if(is_sparse): HL_2d = HL_2d.tocsr(); # to slice out spin blocks
+    assert(is_alpha_conserving(HL_2d,n_loc_dof));
     Emas, psimas = [], []; # will index as Emas[alpha,m]
     n_bound_left = 0;        
     for alpha in range(n_loc_dof):
-        Ems, psims = np.linalg.eigh(HL_4d[:,:,alpha,alpha]);
+        if(updater is not None): Ems, psims = updater(("L", alpha), HL_2d[alpha::n_loc_dof,alpha::n_loc_dof], E_cutoff[alpha,alpha] - 2*tLa);
+        else: Ems, psims = cached(cache, eigh_ham, HL_2d[alpha::n_loc_dof,alpha::n_loc_dof], E_max = E_cutoff[alpha,alpha] - 2*tLa);
         psims = psims.T[Ems+2*tLa < E_cutoff[alpha,alpha]];
         Ems = Ems[Ems+2*tLa < E_cutoff[alpha,alpha]];
         Emas.append(Ems);
@@ -468,12 +408,15 @@ def kernel_well_prime(tinfty, tL, tR,
     Emas, psimas = Emas_arr, psimas_arr # shape is (n_loc_dof, n_bound_left)
 
     # right well eigenstates  
-    HR_4d = Hsysmat(tinfty, tL, tR, Vinfty, VLprime, VR, Ninfty, NL, NR, HCprime);
-    assert(is_alpha_conserving(fci_mod.mat_4d_to_2d(HR_4d),n_loc_dof));
+    HR_4d = Hsysmat(tinfty, tL, tR, Vinfty, VLprime, VR, Ninfty, NL, NR, HCprime, is_sparse=is_sparse);
+    HR_2d = ham_2d(HR_4d);
+    if(is_sparse): HR_2d = HR_2d.tocsr(); # to slice out spin blocks
+    assert(is_alpha_conserving(HR_2d,n_loc_dof));
     Enbs, psinbs = [], []; # will index as Enbs[beta,n]
     n_bound_right = 0;
     for beta in range(n_loc_dof):
-        Ens, psins = np.linalg.eigh(HR_4d[:,:,beta,beta]);
+        if(updater is not None): Ens, psins = updater(("R", beta), HR_2d[beta::n_loc_dof,beta::n_loc_dof], E_cutoff[beta,beta] - 2*tRa);
+        else: Ens, psins = cached(cache, eigh_ham, HR_2d[beta::n_loc_dof,beta::n_loc_dof], E_max = E_cutoff[beta,beta] - 2*tRa);
         psins = psins.T[Ens+2*tRa < E_cutoff[beta,beta]];
         Ens = Ens[Ens+2*tRa < E_cutoff[beta,beta]];
         Enbs.append(Ens.astype(complex));
@@ -492,7 +435,7 @@ def kernel_well_prime(tinfty, tL, tR,
     Enbs, psinbs = Enbs_arr, psinbs_arr # shape is (n_loc_dof, n_bound_right)
 
     # operator
-    Hsys_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VR, Ninfty, NL, NR, HC);
+    Hsys_4d = Hsysmat(tinfty, tL, tR, Vinfty, VL, VR, Ninfty, NL, NR, HC, is_sparse=is_sparse);
     if(verbose > 9): # plot hams
         print("np.shape(Emas) = ",np.shape(Emas));
         print("np.shape(Enbs) = ",np.shape(Enbs));
@@ -503,28 +446,17 @@ def kernel_well_prime(tinfty, tL, tR,
     # average matrix elements over final states |k_n \beta>
     # with the same energy as the intial state |k_m \alpha>
     # average over energy but keep spin separate
-    Hdiff = fci_mod.mat_4d_to_2d(Hsys_4d - HL_4d);
-    Mbmas = np.empty((n_loc_dof,n_bound_left,n_loc_dof),dtype=float);
-    # initial energy and spin states
-    for alpha in range(n_loc_dof):
-        for m in range(n_bound_left):               
-            for beta in range(n_loc_dof):
-                # inelastic means averaging over an energy interval
-                Mns = [];
-                for n in range(n_bound_right):
-                    if( abs(Emas[alpha,m] - Enbs[beta,n]) < interval):
-                        Mns.append( matrix_element(beta,psinbs[:,n],Hdiff,alpha,psimas[:,m]));
-
-                # "adaptive" interval 
-                if( np.isnan(interval) and Mns==[]): 
-                    n_nearest = np.argmin( abs(Emas[alpha,m] - Enbs[beta]) );
-                    Mns.append( matrix_element(beta,psinbs[:,n_nearest],Hdiff,alpha,psimas[:,m]));    
-
-                # update M with average
-                if(verbose): print("\tinterval = ",interval, len(Mns));
-                if Mns: Mns = sum(Mns)/len(Mns);
-                else: Mns = 0.0;
-                Mbmas[beta,m,alpha] = Mns;
+    # psimas[alpha,m] only has spin alpha, so are embedded as in matrix_element
+    # one product on the sites where Hsys and HL differ, for all m and n. These are
+    # HC and, since VR != VRprime, the whole right well
+    Hdiff = ham_2d(Hsys_4d - HL_4d);
+    spin_eye = np.eye(n_loc_dof);
+    psimas_2d = np.einsum("amj,al->amjl", psimas, spin_eye).reshape(n_loc_dof,n_bound_left,-1);
+    psinbs_2d = np.einsum("bnj,bl->bnjl", psinbs, spin_eye).reshape(n_loc_dof,n_bound_right,-1);
+    Mbnams = matrix_elements(psinbs_2d, Hdiff, psimas_2d, n_loc_dof); # [beta,n,alpha,m]
+    Mambs = average_final(Mbnams, Emas[None,None,:,:], Enbs[:,:,None,None], interval, axis=1, verbose=verbose);
+    Mbmas = np.real(np.transpose(Mambs, (0,2,1))); # [beta,alpha,m] -> [beta,m,alpha]
+    del psimas_2d, psinbs_2d, Mbnams, Mambs;
 
     # norm squared of Oppenheimer matrix elements               
     Mbmas = np.real(np.conj(Mbmas)*Mbmas);
@@ -536,42 +468,49 @@ def kernel_well_prime(tinfty, tL, tR,
 
 def current(Emas, Mbmas, Vb, tbulk, muR, kBT, verbose=0) -> np.ndarray:
     '''
-    current as a function of bias voltage
+    current as a function of bias voltage, and of temperature
+
+    Vb is a 1d array of bias voltages. muR and kBT are floats or 1d arrays
+    over temperatures T (muR may depend on T), which broadcast together.
+    The Fermi-Dirac factors of every initial energy, bias and temperature
+    are found at once, and summed over initial energy m in one product
+
+    Returns
+    -Iab, real 3d array, current[alpha,beta,Vb] if muR and kBT are floats,
+        else real 4d array, current[alpha,beta,Vb,T]
     '''
     for arr in [Emas, Mbmas, Vb]:
         if(not isinstance(arr, np.ndarray)): raise TypeError;
     n_loc_dof, n_bound_left = np.shape(Emas);
     Emas = np.real(Emas);
+    is_Ts = (np.ndim(muR) > 0 or np.ndim(kBT) > 0);
+    muR, kBT = np.broadcast_arrays(np.atleast_1d(muR).astype(float), np.atleast_1d(kBT).astype(float));
+
+    # Fermi-Dirac factors, shape (n_loc_dof, n_bound_left, len(Vb), len(T))
+    Es = Emas[:,:,None,None];
+    muL = muR[None,:] + Vb[:,None]; # bias voltage window
+    nR = nFD(Es, muR[None,:], kBT[None,:]);
+    nL = nFD(Es, muL, kBT[None,:]);
+    stat_part = nL*(1-nR) - nR*(1-nL);
+
+    # sum over initial energy m
+    Iab = 2*np.pi*np.einsum("amvt,amb->abvt", stat_part, Mbmas);
+
+    # debug
+    if(verbose>9):
+        alpha = 0;
+        for Vbi in [0,len(Vb)//2-20,len(Vb)//2-10, len(Vb)//2+10,len(Vb)//2+20,len(Vb)-1]:
+            print("stat_part = ", np.shape(stat_part))
+            print("Mbmas = ", np.shape(Mbmas))
+            fig, ax = plt.subplots();
+            ax.plot(Emas[alpha], stat_part[alpha,:,Vbi,0],marker='o');
+            ax.plot(Emas[alpha], Mbmas[alpha,:,alpha]/np.max(Mbmas[alpha,:,alpha]),marker='s'); # normed
+            ax.axvline(muR[0], color="gray", linestyle="dashed");
+            ax.set_title("$V_b = {:.2f}, \mu_L = {:.2f}, \mu_R = {:.2f}$".format(Vb[Vbi], muL[Vbi,0], muR[0]));
+            plt.show();
+        assert False
 
-    # current as a function of spin, Vb
-    Iab = np.empty((n_loc_dof, n_loc_dof, len(Vb)),dtype=float);
-
-    # iter over spin
-    for alpha in range(n_loc_dof):
-        for beta in range(n_loc_dof):
-
-            # iter over bias voltage window
-            for Vbi in range(len(Vb)):
-
-                # bias voltage window
-                muL = muR + Vb[Vbi];
-                stat_part = nFD(Emas[alpha],muL,kBT)*(1-nFD(Emas[alpha],muR,kBT)) - nFD(Emas[alpha],muR,kBT)*(1-nFD(Emas[alpha], muL,kBT));
-    
-                # sum over initial energy m
-                Iab[alpha,beta,Vbi] = 2*np.pi*np.dot(stat_part, Mbmas[alpha,:,beta]);
-
-                # debug
-                if(verbose>9 and alpha==0 and Vbi in [0,len(Vb)//2-20,len(Vb)//2-10, len(Vb)//2+10,len(Vb)//2+20,len(Vb)-1]):
-                    print("stat_part = ", np.shape(stat_part))
-                    print("Mbmas = ", np.shape(Mbmas))
-                    fig, ax = plt.subplots();
-                    ax.plot(Emas[alpha], stat_part,marker='o');
-                    ax.plot(Emas[alpha], Mbmas[alpha,:,alpha]/np.max(Mbmas[alpha,:,alpha]),marker='s'); # normed
-                    ax.axvline(muR, color="gray", linestyle="dashed");
-                    ax.set_title("$V_b = {:.2f}, \mu_L = {:.2f}, \mu_R = {:.2f}$".format(Vb[Vbi], muL, muR));
-                    plt.show();
-    if(verbose>9): assert False
-
+    if(not is_Ts): return Iab[...,0];
     return Iab;
 
 def Ts_bardeen(Emas, Mbmas, tL, tR, VL, VR, NL, NR, verbose = 0) -> np.ndarray:
@@ -674,20 +613,25 @@ def Ts_wfm_well(tL, tR, VL, VR, HC, Emas, verbose=0) -> np.ndarray:
         assert False;
 
     # get probabilities, final spin state resolved
+    # sources alpha with the same lead hopping are solved together, at all of
+    # their energies at once, with one incident state per column
     Tbmas = np.empty((n_loc_dof,n_bound_left,n_loc_dof),dtype=float);
-    for alpha in range(n_loc_dof):
-        source = np.zeros((n_loc_dof,));
-        source[alpha] = 1.0;
-        for m in range(n_bound_left):
-            Rdum, Tdum = wfm.kernel(hblocks, tnn, tnnn, tL[alpha,alpha], Emas[alpha,m], source, verbose = verbose);
-            Tbmas[:,m,alpha] = Tdum;
+    tLs = np.diagonal(tL);
+    for tLval in np.unique(tLs):
+        alphas = np.arange(n_loc_dof)[tLs == tLval];
+        Evals, Einds = np.unique(Emas[alphas], return_inverse = True);
+        Einds = np.reshape(Einds, (len(alphas), n_bound_left));
+        sources = np.eye(n_loc_dof)[:,alphas];
+        Rdum, Tdum = wfm.kernel(hblocks, tnn, tnnn, tLval, Evals, sources, False, False, verbose = verbose);
+        for alphai, alpha in enumerate(alphas):
+            Tbmas[:,:,alpha] = Tdum[Einds[alphai],:,alphai].T;
             
     return Tbmas;
     
 ############################################################################
 #### Hamiltonian construction
 
-def Hsysmat(tinfty, tL, tR, Vinfty, VL, VR, Ninfty, NL, NR, HC, bound=True) -> np.ndarray:
+def Hsysmat(tinfty, tL, tR, Vinfty, VL, VR, Ninfty, NL, NR, HC, bound=True, is_sparse=False) -> np.ndarray:
     '''
     Make the TB Hamiltonian for the full system, general 1D case
     Physical params are classified by region: infty, L, R.
@@ -695,6 +639,13 @@ def Hsysmat(tinfty, tL, tR, Vinfty, VL, VR, Ninfty, NL, NR, HC, bound=True) -> n
     Vinfty, VL, VR is local potential in these regions (2d arr describing local dofs)
     Ninfty, NL, NR is number of sites in these regions
     HC is Hamiltonian of central region (4d arr describing spatial and local dofs)
+
+    Optional args
+    -is_sparse, whether to return a scipy.sparse.bsr_matrix with
+        n_loc_dof x n_loc_dof blocks and spatial and spin indices mixed,
+        as wfm.Hmat does, instead of a dense 4d array. This takes O(nsites)
+        memory instead of O(nsites^2), and can be passed on to get_mstates,
+        get_bound_states and matrix_element as is
     '''
     for arg in [tinfty, tL, tR, Vinfty, VL, VR]:
         if(type(arg) != np.ndarray): raise TypeError;
@@ -716,60 +667,523 @@ def Hsysmat(tinfty, tL, tR, Vinfty, VL, VR, Ninfty, NL, NR, HC, bound=True) -> n
         print("\n\nWARNING: NOT BOUND\n\n");
         VinftyL = VL; VinftyR = VR; del Vinfty;
 
+    # diag blocks outside HC, by region of site j
+    js = np.arange(minusinfty, plusinfty+1);
+    regions = [js < -NL-littleNC, (js >= -NL-littleNC) & (js < -littleNC), # far left, left well
+               (js > littleNC) & (js <= littleNC+NR), js > littleNC+NR]; # right well, far right
+    diag = np.zeros((nsites,n_loc_dof,n_loc_dof),dtype=complex);
+    for region, V in zip(regions, [VinftyL, VL, VR, VinftyR]):
+        diag[region] = V;
+
+    # off diag blocks outside HC, btwn sites j and j+1
+    # the left well hops onto HC and HC hops onto the right well
+    js = js[:-1];
+    regions = [js < -NL-littleNC, (js >= -NL-littleNC) & (js < -littleNC),
+               (js >= littleNC) & (js < littleNC+NR), js >= littleNC+NR];
+    offdiag = np.zeros((nsites-1,n_loc_dof,n_loc_dof),dtype=complex);
+    for region, t in zip(regions, [tinfty, tL, tR, tinfty]):
+        offdiag[region] = -t;
+
+    # (offset, blocks) for each block diagonal
+    sites = np.arange(nsites);
+    diagonals = [(0, diag), (-1, offdiag), (1, offdiag)];
+    Cstart = -littleNC-minusinfty; # first site of HC
+
+    if(is_sparse): # scatter blocks into block sparse row format
+        from scipy.sparse import bsr_matrix
+        rows, cols, data = [], [], [];
+        for offset, blocks in diagonals:
+            rows.append(sites[max(0,-offset):nsites-max(0,offset)]);
+            cols.append(rows[-1] + offset);
+            data.append(blocks);
+        # HC, which has no blocks on the other diagonals
+        Crows, Ccols = np.meshgrid(np.arange(len(HC)), np.arange(len(HC)), indexing = "ij");
+        rows.append(Cstart + Crows.flatten());
+        cols.append(Cstart + Ccols.flatten());
+        data.append(np.reshape(HC, (-1,n_loc_dof,n_loc_dof)));
+        rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data);
+        order = np.lexsort((cols, rows));
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength = nsites))));
+        Hmat = bsr_matrix((data[order], cols[order], indptr),
+                    shape = (n_loc_dof*nsites, n_loc_dof*nsites), blocksize = (n_loc_dof, n_loc_dof));
+        Hmat.sum_duplicates();
+        return Hmat;
+
     # Hamiltonian matrix
     Hmat = np.zeros((nsites,nsites,n_loc_dof,n_loc_dof),dtype=complex);
-    for j in range(minusinfty, plusinfty+1):
-
-        # diag outside HC
-        if(j < -NL - littleNC):  # far left        
-            Hmat[j-minusinfty,j-minusinfty] += VinftyL;
-        elif(j >= -NL-littleNC and j < -littleNC): # left well
-            Hmat[j-minusinfty,j-minusinfty] += VL;
-        elif(j > littleNC and j <= littleNC+NR): # right well
-            Hmat[j-minusinfty,j-minusinfty] += VR;
-        elif(j > littleNC+NR): # far right
-            Hmat[j-minusinfty,j-minusinfty] += VinftyR;
-
-        # off diag outside HC
-        if(j < -NL - littleNC):  # far left         
-            Hmat[j-minusinfty,j+1-minusinfty] += -tinfty;
-            Hmat[j+1-minusinfty,j-minusinfty] += -tinfty;
-        elif(j >= -NL-littleNC and j < -littleNC): # left well
-            Hmat[j-minusinfty,j+1-minusinfty] += -tL;
-            Hmat[j+1-minusinfty,j-minusinfty] += -tL;
-        elif(j > littleNC and j <= littleNC+NR): # right well
-            Hmat[j-minusinfty,j-1-minusinfty] += -tR;
-            Hmat[j-1-minusinfty,j-minusinfty] += -tR; 
-        elif(j > littleNC+NR): # far right
-            Hmat[j-minusinfty,j-1-minusinfty] += -tinfty;
-            Hmat[j-1-minusinfty,j-minusinfty] += -tinfty;
+    for offset, blocks in diagonals:
+        sitei = sites[max(0,-offset):nsites-max(0,offset)];
+        Hmat[sitei, sitei+offset] = blocks;
 
     # HC
-    Hmat[-littleNC-minusinfty:littleNC+1-minusinfty,-littleNC-minusinfty:littleNC+1-minusinfty] = HC;
+    Hmat[Cstart:Cstart+len(HC),Cstart:Cstart+len(HC)] = HC;
             
     return Hmat;
 
+##################################################################################
+#### eigenstate cache
+
+class EigenCache():
+    def __init__(self, max_MB = 1024, cache_dir = None, verbose = 0):
+        '''
+        Size bounded, least recently used cache of eigenstates (the outputs of
+        get_mstates, get_bound_states, eigh_ham), keyed on a hash of the
+        contents of their args, so that sweeps which only change HC or one
+        barrier do not diagonalize the unchanged lead hamiltonians again.
+        Pass the same EigenCache as the cache kwarg of the kernel_well* kernels
+        at every sweep point
+        Args
+        -max_MB, float, cached arrays in memory are evicted, least recently
+            used first, when their total size exceeds this
+        -cache_dir, str, if given, cached arrays are saved there as .npy files
+            and read back as read-only np.memmap's, so they do not take up
+            memory (or count towards max_MB) and are kept for later runs,
+            which look them up by hash. Files are never deleted
+        '''
+        import collections
+        self.max_bytes = max_MB*1e6;
+        self.cache_dir = cache_dir;
+        if(cache_dir is not None):
+            import os
+            os.makedirs(cache_dir, exist_ok = True);
+        self.verbose = verbose;
+        self.entries = collections.OrderedDict(); # key -> tuple of arrays
+        self.nbytes = 0;
+        self.n_hits, self.n_misses = 0, 0;
+
+    def key(self, func, *args, **kwargs) -> str:
+        '''
+        Hash of the name of func and the contents of its args. Arrays, dense
+        or sparse, are hashed by their bytes, shape and dtype, all else by repr
+        '''
+        import hashlib
+        hasher = hashlib.blake2b(func.__name__.encode(), digest_size = 20);
+        for arg in list(args) + [kwargs[name] for name in sorted(kwargs)]:
+            if(is_sparse_ham(arg)):
+                arg = arg.tocsr();
+                arg.sum_duplicates();
+                parts = [arg.data, arg.indices, arg.indptr];
+            elif(isinstance(arg, np.ndarray)): parts = [arg];
+            else: parts = [];
+            for part in parts:
+                hasher.update(repr((np.shape(part), part.dtype.str)).encode());
+                hasher.update(np.ascontiguousarray(part).view(np.uint8));
+            if(not parts): hasher.update(repr(arg).encode());
+            hasher.update(repr(np.shape(arg)).encode() + b"|");
+        for name in sorted(kwargs): hasher.update(name.encode());
+        return hasher.hexdigest();
+
+    def paths(self, key, n_out) -> list:
+        '''
+        Files in cache_dir of the n_out outputs cached under key
+        '''
+        import os
+        return [os.path.join(self.cache_dir, key+"_{:.0f}.npy".format(outi)) for outi in range(n_out)];
+
+    def load(self, key):
+        '''
+        Cached outputs from cache_dir, or None
+        '''
+        import os
+        if(self.cache_dir is None): return None;
+        n_out = 0;
+        while(os.path.exists(self.paths(key, n_out+1)[-1])): n_out += 1;
+        if(n_out == 0): return None;
+        return tuple([np.load(path, mmap_mode = "r") for path in self.paths(key, n_out)]);
+
+    def store(self, key, outs) -> tuple:
+        '''
+        Cache outputs as read-only arrays, evicting as needed
+        '''
+        outs = tuple([np.array(out) for out in outs]);
+        if(self.cache_dir is not None):
+            for out, path in zip(outs, self.paths(key, len(outs))): np.save(path, out);
+            outs = self.load(key);
+        for out in outs: out.flags.writeable = False;
+        self.entries[key] = outs;
+        self.nbytes += self.in_memory(outs);
+        while(self.nbytes > self.max_bytes and len(self.entries) > 1):
+            self.evict();
+        return outs;
+
+    def in_memory(self, outs) -> int:
+        '''
+        Bytes of cached outputs which are in memory, not memmapped from cache_dir
+        '''
+        return sum([out.nbytes for out in outs if not isinstance(out, np.memmap)]);
+
+    def evict(self) -> None:
+        '''
+        Drop the least recently used entry from memory. Its files in
+        cache_dir, if any, are kept
+        '''
+        key, outs = self.entries.popitem(last = False);
+        self.nbytes -= self.in_memory(outs);
+        if(self.verbose > 1): print(" - evicted "+key);
+
+    def __call__(self, func, *args, **kwargs) -> tuple:
+        '''
+        func(*args, **kwargs), from the cache if it was called before with
+        args of the same contents. verbose is not part of the key
+        '''
+        key_kwargs = {name: kwargs[name] for name in kwargs if name != "verbose"};
+        key = self.key(func, *args, **key_kwargs);
+        if(key in self.entries):
+            self.entries.move_to_end(key);
+            self.n_hits += 1;
+            return self.entries[key];
+        outs = self.load(key);
+        if(outs is not None): # from an earlier run
+            self.n_hits += 1;
+            self.entries[key] = outs;
+            self.nbytes += self.in_memory(outs);
+            while(self.nbytes > self.max_bytes and len(self.entries) > 1):
+                self.evict();
+            return outs;
+        self.n_misses += 1;
+        if(self.verbose): print(" - "+func.__name__+" not in cache, {:.0f} hits, {:.0f} misses".format(self.n_hits, self.n_misses));
+        return self.store(key, func(*args, **kwargs));
+
+class EigenUpdater():
+    def __init__(self, margin = 0.1, n_iter = 2, tol = 1e-8, verbose = 0):
+        '''
+        Bound states of hamiltonians which change only on a few sites from one
+        call to the next, up to a uniform shift, as in a dense scan of J or
+        Delta (added to HC, or to HC and every V). The first
+        call in each slot (eg ("L", alpha)) is diagonalized in full and kept
+        as the reference, later calls are found from it by eigh_update, and
+        when an update is rejected its full solution becomes the reference.
+        Pass the same EigenUpdater as the updater kwarg of kernel_well_prime
+        at every scan point
+        Args
+        -margin, float, references are solved up to E_max + margin, so that
+            states pushed below E_max by the change are in the update
+        -n_iter, int, tol, float, as in eigh_update
+        '''
+        self.margin = margin;
+        self.n_iter, self.tol = n_iter, tol;
+        self.verbose = verbose;
+        self.references = {}; # slot -> H0_2d, E0s, psi0s
+        self.n_updates, self.n_full = 0, 0;
+
+    def __call__(self, slot, H_2d, E_max) -> tuple:
+        '''
+        Eigenstates of H_2d with energy <= E_max, as eigh_ham(H_2d, E_max)
+        '''
+        if(slot in self.references and np.shape(self.references[slot][0]) == np.shape(H_2d)):
+            H0_2d, E0s, psi0s = self.references[slot];
+            Es, psis, is_accepted = eigh_update(H_2d, H0_2d, E0s, psi0s, E_max, n_iter = self.n_iter, tol = self.tol, fallback = False, verbose = self.verbose);
+            if(is_accepted):
+                self.n_updates += 1;
+                return Es, psis;
+        self.n_full += 1;
+        if(self.verbose): print(" - "+str(slot)+" solved in full, {:.0f} updates, {:.0f} full".format(self.n_updates, self.n_full));
+        E0s, psi0s = eigh_ham(H_2d, E_max = E_max + self.margin);
+        self.references[slot] = (H_2d.copy(), E0s, psi0s);
+        return E0s[E0s <= E_max], psi0s[:,E0s <= E_max];
+
+def cached(cache, func, *args, **kwargs):
+    '''
+    func(*args, **kwargs), through cache if it is an EigenCache
+    '''
+    if(cache is None): return func(*args, **kwargs);
+    return cache(func, *args, **kwargs);
+
 ##################################################################################
 #### utils
 
-def get_mstates(H_4d, ta, verbose=0) -> tuple:
+def is_sparse_ham(H) -> bool:
+    '''
+    Whether H is a scipy.sparse matrix, as from Hsysmat(..., is_sparse=True)
+    '''
+    from scipy.sparse import issparse
+    return issparse(H);
+
+def ham_2d(H):
+    '''
+    H with spatial and spin indices mixed. Dense 4d arrays are converted,
+    sparse matrices already are 2d and are returned as is
+    '''
+    if(is_sparse_ham(H)): return H;
+    n_spatial_dof, n_loc_dof = np.shape(H)[0], np.shape(H)[-1];
+    return np.transpose(H, (0,2,1,3)).reshape(n_spatial_dof*n_loc_dof, n_spatial_dof*n_loc_dof); # as fci_mod.mat_4d_to_2d
+
+def site_op(op, n_spatial_dof, is_sparse=False):
+    '''
+    The local dof operator op acting at every site, with spatial and spin
+    indices mixed, as a scipy.sparse matrix if is_sparse
+    '''
+    if(is_sparse):
+        from scipy.sparse import kron, identity
+        return kron(identity(n_spatial_dof), op, format="bsr");
+    return np.kron(np.eye(n_spatial_dof), op);
+
+def eigh_ham(H_2d, E_max=None) -> tuple:
+    '''
+    Eigenvalues and eigenvectors (as columns) of a 2d hamiltonian. Sparse
+    matrices are not densified, rather their lower band (one block wide, or
+    as wide as HC) is diagonalized by scipy.linalg.eig_banded
+
+    Optional args
+    -E_max, float, only find the eigenstates with energy <= E_max. LAPACK
+        then skips the eigenvectors of all other states, which are most of
+        them for the bound states of a well
+
+    Hamiltonians which are stored as complex but are real are diagonalized
+    as real, which is several times faster
+
+    The phase of each eigenvector is fixed by fix_phase, so that it does not
+    depend on which LAPACK routine found it
+    '''
+    from scipy.linalg import eigh, eig_banded
+    if(not is_sparse_ham(H_2d)):
+        if(np.iscomplexobj(H_2d) and not np.any(np.imag(H_2d))): H_2d = np.real(H_2d);
+        if(E_max is None): Es, psis = np.linalg.eigh(H_2d);
+        else: Es, psis = eigh(H_2d, subset_by_value=(-np.inf, E_max));
+    else:
+        band = lower_band(H_2d);
+        if(E_max is None): Es, psis = eig_banded(band, lower=True);
+        else: Es, psis = eig_banded(band, lower=True, select='v', select_range=(-np.inf, E_max));
+    return Es, fix_phase(psis);
+
+def fix_phase(psis) -> np.ndarray:
+    '''
+    Eigenvectors (as columns) with the phase chosen so that the largest in
+    magnitude component of each is real and positive. kernel_well_prime
+    averages signed matrix elements over final states before squaring them,
+    so with a finite interval its output depends on this choice
+    '''
+    largest = psis[np.argmax(abs(psis), axis=0), np.arange(np.shape(psis)[-1])];
+    return psis*(np.conj(largest)/np.maximum(abs(largest), 1e-300));
+
+def lower_band(H_2d) -> np.ndarray:
+    '''
+    Lower band of a hermitian 2d hamiltonian (dense or sparse), in the
+    storage of scipy.linalg.eig_banded, a_band[i-j,j] = a[i,j]. Real if H is
+    '''
+    from scipy.sparse import coo_matrix
+    H_coo = coo_matrix(H_2d);
+    lower = (H_coo.row >= H_coo.col) & (H_coo.data != 0);
+    rows, cols = H_coo.row[lower], H_coo.col[lower];
+    band = np.zeros((np.max(rows-cols, initial=0)+1, np.shape(H_2d)[0]), dtype=H_coo.dtype);
+    np.add.at(band, (rows-cols, cols), H_coo.data[lower]);
+    if(np.iscomplexobj(band) and not np.any(np.imag(band))): band = np.real(band);
+    return band;
+
+def count_below(H_2d, E) -> int:
+    '''
+    Number of eigenvalues of a hermitian 2d hamiltonian (dense or sparse)
+    below E, by Sylvester's law of inertia, without diagonalizing it.
+    H is block tridiagonal with blocks at least as wide as its band, so the block LDL^T
+    factors D_j = A_j - B_j D_{j-1}^{-1} B_j^\dagger of H - E have as many
+    negative eigenvalues, all together, as H - E does. Raises LinAlgError
+    when E is an eigenvalue of a leading block D_j
+    '''
+    band = lower_band(H_2d);
+    width = max(len(band)-1, 32); # wider blocks mean fewer python iterations
+    n_blocks = -(-len(band[0]) // width);
+    padded = np.zeros((len(band), n_blocks*width), dtype=band.dtype);
+    padded[:,:len(band[0])] = band;
+    padded[0,len(band[0]):] = E + 1.0; # padding adds no eigenvalues below E
+    padded[0] -= E;
+
+    # diagonal and lower blocks of H - E from the band
+    rows, cols = np.meshgrid(np.arange(width), np.arange(width), indexing="ij");
+    def block(blocki, offset):
+        i, j = (blocki+offset)*width + rows, blocki*width + cols; # H[i,j], i >= j unless offset == 0
+        lower = (i >= j) & (i-j < len(padded));
+        A = np.zeros((width, width), dtype=padded.dtype);
+        A[lower] = padded[(i-j)[lower], j[lower]];
+        if(offset == 0): A = A + np.conj(np.tril(A, -1).T);
+        return A;
+
+    n_below = 0;
+    D = block(0, 0);
+    for blocki in range(n_blocks):
+        if(blocki > 0):
+            B = block(blocki-1, 1);
+            D = block(blocki, 0) - B @ np.linalg.solve(D, np.conj(B.T));
+        n_below += np.sum(np.linalg.eigvalsh(D) < 0);
+    return int(n_below);
+
+def eigh_update(H_2d, H0_2d, E0s, psi0s, E_max, n_iter=2, tol=1e-8, fallback=True, verbose=0) -> tuple:
+    '''
+    Eigenstates of H_2d with energy <= E_max, from the eigenstates E0s, psi0s
+    (as columns) of a reference hamiltonian H0_2d which differs from H_2d by
+    a uniform shift of the on site energies (eg Delta added to every V)
+    plus a change on only a few sites (eg in HC). The shift moves E0s but
+    not psi0s. The change on a few sites is corrected for by a step of
+    Rayleigh quotient iteration from each reference eigenstate, a banded
+    solve (H - sigma) psi = psi0, and H is diagonalized in the space of the
+    reference eigenstates and these corrections (Rayleigh-Ritz). This is
+    repeated from the new eigenstates up to n_iter times
+
+    The update is only accepted if every eigenstate has residual
+    |H psi - E psi| < tol and the number of eigenstates equals the number of
+    eigenvalues of H below E_max (see count_below). It is not tried when
+    H - H0 is nonzero on more than a tenth of the dofs. Rejected updates
+    fall back to eigh_ham, or with fallback=False are returned as is (Es,
+    psis are None when not tried). psi0s should go a little above E_max,
+    ie the reference should be solved with a higher E_max, to catch states
+    which are pushed below E_max
+
+    Returns Es, psis (as columns) as eigh_ham does, and whether the update
+    was accepted
+    '''
+    from scipy.linalg import solve_banded, LinAlgError
+    from scipy.sparse import csr_matrix, identity
+    if(np.shape(H_2d) != np.shape(H0_2d)): raise ValueError;
+    n_dof = np.shape(H_2d)[0];
+    H_2d, H0_2d = csr_matrix(H_2d), csr_matrix(H0_2d); # only the band of H is used
+    Hdiff = H_2d - H0_2d;
+    shift = np.median(np.real(Hdiff.diagonal()));
+    Hdiff = (Hdiff - shift*identity(n_dof)).tocsr();
+    Hdiff.data[abs(Hdiff.data) < 1e-12*max(1.0, abs(shift))] = 0; # rounding of the shift
+    dofs, Hdiff_dofs = op_support(Hdiff, 1);
+    E0s = E0s + shift;
+
+    # only shifted, so exact as long as the reference goes above E_max
+    if(len(dofs) == 0 and np.max(E0s, initial=-np.inf) > E_max):
+        if(verbose): print(" - eigh_update: shifted by {:.2e}, {:.0f} states".format(shift, np.sum(E0s <= E_max)));
+        return E0s[E0s <= E_max], psi0s[:,E0s <= E_max], True;
+    if(len(dofs) == 0 or len(dofs) > n_dof/10):
+        if(verbose): print(" - eigh_update: H - H0 is nonzero on {:.0f} dofs, not tried".format(len(dofs)));
+        if(fallback): return eigh_ham(H_2d, E_max=E_max) + (False,);
+        return None, None, False;
+
+    # H - sigma in the storage of scipy.linalg.solve_banded, ab[u+i-j,j] = a[i,j]
+    band = lower_band(H_2d);
+    width = len(band)-1;
+    ab = np.zeros((2*width+1, n_dof), dtype=band.dtype);
+    ab[width:] = band;
+    for offset in range(1, width+1): ab[width-offset,offset:] = np.conj(band[offset,:-offset]);
+    if(np.isrealobj(band) and not np.any(np.imag(psi0s))): # real arithmetic, as in eigh_ham
+        H_2d, psi0s, Hdiff_dofs = H_2d.real, np.real(psi0s), np.real(Hdiff_dofs);
+
+    # Rayleigh quotients of the reference eigenstates are local corrections to E0s
+    psis = psi0s;
+    thetas = E0s + np.real(np.sum(np.conj(psi0s[dofs])*(Hdiff_dofs @ psi0s[dofs]), axis=0));
+    try:
+        for _ in range(n_iter):
+            new = np.empty_like(psis);
+            for statei in range(len(thetas)):
+                ab[width] = band[0] - thetas[statei];
+                new[:,statei] = solve_banded((width, width), ab, psis[:,statei], check_finite=False);
+            basis, _ = np.linalg.qr(np.append(psis, new, axis=-1)); # Householder, so stable even though new ~ psis
+
+            # Rayleigh-Ritz
+            H_basis_cols = H_2d @ basis;
+            H_basis = np.conj(basis.T) @ H_basis_cols;
+            thetas, ys = np.linalg.eigh((H_basis + np.conj(H_basis.T))/2);
+            thetas, ys = thetas[thetas <= np.max(E0s)], ys[:,thetas <= np.max(E0s)];
+            psis = basis @ ys;
+            residuals = np.linalg.norm(H_basis_cols @ ys - psis*thetas, axis=0);
+            if(np.all(residuals[thetas <= E_max] < tol)): break;
+    except LinAlgError: # sigma is an eigenvalue to machine precision
+        residuals = np.full((len(thetas),), np.inf);
+    psis, residuals, thetas = psis[:,thetas <= E_max], residuals[thetas <= E_max], thetas[thetas <= E_max];
+    is_accepted = bool(np.all(residuals < tol)); # only count when the residuals pass
+    try:
+        n_below = count_below(H_2d, E_max) if is_accepted else None;
+    except LinAlgError: # E_max is an eigenvalue of a leading block
+        n_below = None;
+    is_accepted = is_accepted and (len(thetas) == n_below);
+    if(verbose): print(" - eigh_update: shifted by {:.2e}, {:.0f} of {} states, max residual = {:.2e}".format(shift, len(thetas), n_below, np.max(residuals, initial=0.0)));
+    if(not is_accepted and fallback):
+        Es, psis = eigh_ham(H_2d, E_max=E_max);
+        return Es, psis, False;
+    return thetas, fix_phase(psis), is_accepted;
+
+def get_mstates(H_4d, ta, E_cutoff=None, verbose=0) -> tuple:
     '''
     There is no cutoff because we need a complete basis!
+    H_4d may also be sparse, as from Hsysmat(..., is_sparse=True)
+
+    Optional args
+    -E_cutoff, float, if given, only find the states with Em + 2ta below it.
+        This is much faster but the basis is no longer complete
     '''
-    H_2d = fci_mod.mat_4d_to_2d(H_4d);
-    Ems, psims = np.linalg.eigh(H_2d);
+    if(E_cutoff is None): Ems, psims = eigh_ham(ham_2d(H_4d));
+    else:
+        Ems, psims = eigh_ham(ham_2d(H_4d), E_max = np.max(E_cutoff) - 2*ta);
+        psims = psims[:,Ems+2*ta < np.max(E_cutoff)];
+        Ems = Ems[Ems+2*ta < np.max(E_cutoff)];
     return Ems.astype(complex), psims.T;
 
+def alpha_sectors(H_2d, alpha_mat, tol=1e-9) -> tuple:
+    '''
+    When alpha_mat has n_loc_dof distinct eigenvalues and commutes with H,
+    H is block diagonal in the eigenbasis of alpha_mat at every site.
+    Returns the eigenvectors of alpha_mat (as columns) and the list of
+    n_spatial_dof x n_spatial_dof blocks of H, one for each alpha, or
+    None, None when alpha is not a good quantum number
+    '''
+    n_loc_dof = np.shape(alpha_mat)[-1];
+    n_spatial_dof = np.shape(H_2d)[0] // n_loc_dof;
+    alpha_vals, alpha_vecs = np.linalg.eigh(alpha_mat);
+    if(np.any(np.diff(alpha_vals) < tol)): return None, None;
+
+    # rotate every site into the alpha basis
+    if(is_sparse_ham(H_2d)):
+        U_2d = site_op(alpha_vecs.astype(complex), n_spatial_dof, is_sparse = True);
+        H_alpha = (U_2d.conj().T @ H_2d @ U_2d).tocsr();
+    else:
+        H_alpha = np.einsum("ak,iajb,bl->ikjl", np.conj(alpha_vecs), np.reshape(H_2d, (n_spatial_dof,n_loc_dof,n_spatial_dof,n_loc_dof)), alpha_vecs);
+        H_alpha = np.reshape(H_alpha, np.shape(H_2d));
+    if(not is_alpha_conserving(H_alpha, n_loc_dof, tol=tol)): return None, None;
+    return alpha_vecs, [H_alpha[alpha::n_loc_dof,alpha::n_loc_dof] for alpha in range(n_loc_dof)];
+
 def get_bound_states(H_4d, ta, alpha_mat, E_cutoff, expval_tol = 1e-9, verbose=0) -> tuple:
     '''
+    Eigenstates of H_4d (which may also be sparse) with Em + 2ta below the
+    cutoff, classified by their alpha_mat eigenvalue alpha
+    Returns
+    -Emas, complex 2d array, energies of each alpha
+    -psimas, complex 3d array, eigenstates (spatial and spin dofs mixed)
+
+    When alpha_mat commutes with H, each alpha sector is diagonalized on its
+    own, otherwise all of H is and the eigenstates are classified by their
+    expectation value of alpha_mat, to within expval_tol
     '''
-    n_spatial_dof = np.shape(H_4d)[0];
-    n_loc_dof = np.shape(H_4d)[-1];
+    n_loc_dof = np.shape(alpha_mat)[-1];
+    H_2d = ham_2d(H_4d); # H_4d may also be sparse
+    n_spatial_dof = np.shape(H_2d)[0] // n_loc_dof;
     E_cutoff_first = np.max(E_cutoff);
 
-    # all eigenstates
-    H_2d = fci_mod.mat_4d_to_2d(H_4d);
-    Ems, psims = np.linalg.eigh(H_2d);
+    # n_loc_dof problems of size n_spatial_dof, with alpha known exactly
+    alpha_vecs, H_alphas = alpha_sectors(H_2d, alpha_mat, tol=expval_tol);
+    if(H_alphas is not None):
+        Ems, psims, alphams = [], [], [];
+        for alpha in range(n_loc_dof):
+            Es_this_a, vecs_this_a = eigh_ham(H_alphas[alpha], E_max = E_cutoff_first - 2*ta);
+            Ems.append(Es_this_a);
+            psims.append(np.reshape(vecs_this_a.T[:,:,None]*alpha_vecs[:,alpha], (len(Es_this_a),-1)));
+            alphams.append(np.full(len(Es_this_a), alpha));
+        Ems, psims, alphams = np.concatenate(Ems), np.concatenate(psims), np.concatenate(alphams);
+
+        # same cutoff as below, lowest states first
+        order = np.argsort(Ems, kind="stable");
+        num_cutoff = np.sum(Ems+2*ta < E_cutoff_first);
+        order = order[:(num_cutoff//n_loc_dof)*n_loc_dof];
+        Ems, psims, alphams = Ems[order].astype(complex), psims[order], alphams[order];
+
+        # alphas are ordered by their lowest state, as when classifying below
+        _, first = np.unique(alphams, return_index = True);
+        if(len(first) != n_loc_dof): raise Exception("alpha vals");
+        alpha_order = alphams[np.sort(first)];
+        n_bound_left = np.min(np.bincount(alphams, minlength = n_loc_dof));
+        Emas_arr = np.empty((n_loc_dof,n_bound_left),dtype=complex);
+        psimas_arr = np.empty((n_loc_dof,n_bound_left,np.shape(psims)[-1]),dtype=complex);
+        for alphai, alpha in enumerate(alpha_order):
+            Es_this_a, psis_this_a = Ems[alphams == alpha][:n_bound_left], psims[alphams == alpha][:n_bound_left];
+            below = (Es_this_a + 2*ta < E_cutoff[alphai,alphai]);
+            Emas_arr[alphai,below] = Es_this_a[below];
+            psimas_arr[alphai,below] = psis_this_a[below];
+        if(verbose): print(">>>", np.shape(Emas_arr));
+        return Emas_arr, psimas_arr;
+
+    # eigenstates below the cutoff only
+    Ems, psims = eigh_ham(H_2d, E_max = E_cutoff_first - 2*ta);
 
     # cutoff
     num_cutoff = len(Ems[Ems+2*ta < E_cutoff_first]);
@@ -778,18 +1192,14 @@ def get_bound_states(H_4d, ta, alpha_mat, E_cutoff, expval_tol = 1e-9, verbose=0
     if(verbose): print(">>>", np.shape(Ems));
 
     # measure alpha val for each k_m
-    alpha_mat_4d = np.zeros((n_spatial_dof, n_spatial_dof, n_loc_dof, n_loc_dof),dtype=complex);
-    for sitej in range(n_spatial_dof):
-        alpha_mat_4d[sitej,sitej] = np.copy(alpha_mat);
-    alpha_mat_2d = fci_mod.mat_4d_to_2d(alpha_mat_4d);
-    alphams = np.empty((len(Ems),),dtype=complex);
-    for m in range(len(Ems)):
-        alphams[m] = np.dot( np.conj(psims[m]), np.matmul(alpha_mat_2d, psims[m]));
+    alpha_mat_2d = site_op(alpha_mat.astype(complex), n_spatial_dof, is_sparse = is_sparse_ham(H_2d));
+    alphams = np.sum(np.conj(psims)*(alpha_mat_2d @ psims.T).T, axis=-1);
 
     # commutator of alpha_mat with H
     # when alpha eigval classification fails, it is because they don't commute!
-    commutator = np.matmul(alpha_mat_2d, H_2d) - np.matmul(H_2d, alpha_mat_2d);
-    if(verbose): print("\ncommutator = ", np.max(abs(commutator)));
+    if(verbose):
+        commutator = alpha_mat_2d @ H_2d - H_2d @ alpha_mat_2d;
+        print("\ncommutator = ", abs(commutator).max());
 
     # get all unique alpha vals, should be exactly n_loc_dof of them
     if(verbose):
@@ -832,16 +1242,92 @@ def get_bound_states(H_4d, ta, alpha_mat, E_cutoff, expval_tol = 1e-9, verbose=0
 
     return Emas_arr, psimas_arr;
 
+def site_expvals(psis, op) -> np.ndarray:
+    '''
+    <psi| op |psi> of the local dof operator op acting at every site, for
+    states psis[..., spatial and spin dofs mixed], without forming the 2d
+    operator on all sites
+    '''
+    n_loc_dof = len(op);
+    psis_sites = np.reshape(psis, np.shape(psis)[:-1] + (-1, n_loc_dof));
+    return np.einsum("...jl,lk,...jk->...", np.conj(psis_sites), op, psis_sites);
+
+def classify_expvals(expvals, expvals_exact, expval_tol, label="") -> tuple:
+    '''
+    Assign each state to the nearest of expvals_exact, to within expval_tol
+    Returns
+    -index into expvals_exact of each state, 1d int array
+    -rank of each state among those with the same index, in order, 1d int array
+    '''
+    dists = abs(np.asarray(expvals)[:,None] - expvals_exact[None,:]);
+    indices = np.argmin(dists, axis=-1);
+    is_far = (dists[np.arange(len(indices)), indices] >= expval_tol);
+    if(np.any(is_far)): raise Exception("<Sz>_"+label+" = "+str(expvals[np.argmax(is_far)])+" not an eigenval of Sz");
+    ranks = np.empty(len(indices), dtype=int);
+    for index in range(len(expvals_exact)):
+        ranks[indices == index] = np.arange(np.sum(indices == index));
+    return indices, ranks;
+
+def op_support(op, n_loc_dof) -> tuple:
+    '''
+    Sites where the 2d operator op (dense or sparse) has any nonzero element
+    Returns
+    -the spatial and spin dof indices of those sites, 1d array
+    -op restricted to them, dense 2d array
+    '''
+    if(is_sparse_ham(op)):
+        op = op.tocsr();
+        op_coo = op.tocoo();
+        nonzero = (op_coo.data != 0);
+        rows, cols = op_coo.row[nonzero], op_coo.col[nonzero];
+    else:
+        rows, cols = np.nonzero(op);
+    sites = np.unique(np.concatenate((rows, cols)) // n_loc_dof);
+    dofs = (sites[:,None]*n_loc_dof + np.arange(n_loc_dof)).flatten();
+    if(is_sparse_ham(op)): return dofs, op[dofs][:,dofs].toarray();
+    return dofs, op[np.ix_(dofs, dofs)];
+
+def matrix_elements(psins, op, psims, n_loc_dof) -> np.ndarray:
+    '''
+    <psi_n| op |psi_m> for every pair of states (spatial and spin dofs mixed
+    along the last axis), as one product restricted to the sites where op is
+    nonzero, which for Hsys - HL are HC and the right well (VR - VRprime),
+    but not the left well or the leads
+    Returns array of shape psins.shape[:-1] + psims.shape[:-1]
+    '''
+    dofs, op_S = op_support(op, n_loc_dof);
+    psins_S = np.reshape(psins[...,dofs], (-1, len(dofs)));
+    psims_S = np.reshape(psims[...,dofs], (-1, len(dofs)));
+    melements = np.conj(psins_S) @ op_S @ psims_S.T;
+    return np.reshape(melements, np.shape(psins)[:-1] + np.shape(psims)[:-1]);
+
+def average_final(Mnms, Ems, Ens, interval, axis, verbose=0) -> np.ndarray:
+    '''
+    Average matrix elements Mnms over the final states n (along axis) with
+    energy within interval of the initial energy, |Em - En| < interval, or
+    take the nearest final state only if interval is nan. Ems and Ens
+    broadcast against Mnms
+    '''
+    dEs = np.broadcast_to(abs(Ems - Ens), np.shape(Mnms));
+    if(np.isnan(interval)): # "adaptive" interval
+        n_nearest = np.expand_dims(np.argmin(dEs, axis=axis), axis);
+        return np.squeeze(np.take_along_axis(Mnms, n_nearest, axis=axis), axis);
+    is_close = (dEs < interval);
+    counts = np.sum(is_close, axis=axis);
+    if(verbose): print("\tinterval = ",interval, counts);
+    sums = np.sum(np.where(is_close, Mnms, 0.0), axis=axis);
+    return np.where(counts > 0, sums/np.maximum(counts, 1), 0.0);
+
 def matrix_element(beta,psin,op,alpha,psim) -> complex:
     '''
     Take the matrix element of a
     -not in general alpha conserving 2d operator, with spin/spatial dofs mixed
     -alpha conserving 2d state vector, with spin/spatial dofs separated
     '''
-    if(len(np.shape(op))!=2): raise ValueError; # op should be flattened
+    if(len(np.shape(op))!=2): raise ValueError; # op should be flattened, may be sparse
     n_loc_dof = np.shape(psim)[0];
     n_spatial_dof = np.shape(psim)[1]
-    n_ov_dof = len(op);
+    n_ov_dof = np.shape(op)[0];
     if(n_ov_dof % n_spatial_dof != 0): raise ValueError;
     if(n_ov_dof // n_spatial_dof != n_loc_dof): raise ValueError;
 
@@ -854,30 +1340,31 @@ def matrix_element(beta,psin,op,alpha,psim) -> complex:
     psinbeta[beta] = psin[beta]; # all zeros except for psi[beta]
     psinbeta = fci_mod.vec_2d_to_1d(psinbeta.T); # flatten
     assert(is_alpha_conserving(psinbeta,n_loc_dof));
-    return np.dot(np.conj(psinbeta), np.dot(op,psimalpha));
+    return np.dot(np.conj(psinbeta), op @ psimalpha);
 
 def is_alpha_conserving(T,n_loc_dof,tol=1e-9) -> bool:
     '''
     Determines if a tensor T conserves alpha in the sense that it has
     only nonzero elements for a certain value of alpha
     '''
-    if( type(T) != np.ndarray): raise TypeError;
+    if( type(T) != np.ndarray and not is_sparse_ham(T)): raise TypeError;
 
     shape = np.shape(T);
-    indices = np.array(range(*shape));
     if len(shape) == 1: # is a vector
+        indices = np.array(range(*shape));
         alphas = np.full(n_loc_dof, 1, dtype = int);
         for ai in range(n_loc_dof):
             alphas[ai] = np.any(abs(T[indices % n_loc_dof == ai]) > tol);
         return (sum(alphas) == 1 or sum(alphas) == 0);
 
-    elif len(shape) == 2: #matrix
-        for i in range(shape[0]):
-            for j in range(shape[1]):
-                if(abs(T[i,j]) > tol):
-                    if(i % n_loc_dof != j % n_loc_dof):
-                        return False;
-        return True;
+    elif len(shape) == 2: #matrix, dense or sparse
+        if(is_sparse_ham(T)):
+            T = T.tocoo();
+            nonzero = (abs(T.data) > tol);
+            rows, cols = T.row[nonzero], T.col[nonzero];
+        else:
+            rows, cols = np.nonzero(abs(T) > tol);
+        return not np.any(rows % n_loc_dof != cols % n_loc_dof);
 
     else: raise NotImplementedError; 
 
@@ -1014,10 +1501,13 @@ def plot_wfs(h_4d, psimas, Emas, which_m = 0, title = "$H$", imag_tol = 1e-12, r
 def nFD(epsilon,mu,kBT):
      '''
      Fermi-Dirac distribution function, epsilon is the free variable
+     mu and kBT may be floats or arrays, which broadcast against epsilon.
+     Computed without overflow for kBT << |epsilon - mu|
      '''
+     from scipy.special import expit
      if(not isinstance(epsilon, np.ndarray)): raise TypeError;
-     if(not isinstance(mu, float)): raise TypeError;
-     return 1/(np.exp((epsilon-mu)/kBT )+1)
+     if(not isinstance(mu, (float, np.ndarray))): raise TypeError;
+     return expit(-(epsilon-mu)/kBT);
 
 def couple_to_cont(H, E, alpha0) -> np.ndarray:
     '''
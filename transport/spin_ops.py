@@ -0,0 +1,106 @@
+'''
+Christian Bunker
+M^2QM at UF
+October 2026
+
+Spin operators and hamiltonian blocks for molecular spin qubit (MSQ) models,
+where an itinerant electron (spin 1/2) interacts with n_spins localized
+impurity spins of spin TwoS/2
+
+The local dof basis is | electron spin > x | impurity 0 > x ...
+with each spin ordered from m = +s down to m = -s, as in h_cicc
+
+All factories are memoized on their args, and return read-only arrays, so
+that hamiltonian blocks can be built at every energy and sweep point by a
+few array additions, eg for 2 impurities at sites i1, i2
+    hblocks[i1] = J*spin_ops.exchange(TwoS, 2, 0) + Vq*spin_ops.identity(TwoS, 2)
+    hblocks[i2] = J*spin_ops.exchange(TwoS, 2, 1) + Vq*spin_ops.identity(TwoS, 2)
+'''
+
+import numpy as np
+import functools
+
+##################################################################################
+#### single spins
+
+def read_only(arr) -> np.ndarray:
+    '''
+    Lock an array so that a cached copy cannot be changed in place
+    '''
+    arr.flags.writeable = False;
+    return arr;
+
+@functools.lru_cache(maxsize = None)
+def spin_matrices(TwoS) -> tuple:
+    '''
+    Sz, S+, S- of a single spin s = TwoS/2, in the basis m = +s, ..., -s
+    '''
+    if(not isinstance(TwoS, (int, np.integer)) or TwoS < 1): raise ValueError;
+    TwoS_ladder = (2*np.arange(TwoS+1) -TwoS)[::-1];
+    Sz = np.diagflat(0.5*TwoS_ladder);
+    Splus = np.diagflat(np.sqrt(0.5*TwoS*(0.5*TwoS+1)-0.5*TwoS_ladder[1:]*(0.5*TwoS_ladder[1:]+1)),k=1);
+    Sminus = np.diagflat(np.sqrt(0.5*TwoS*(0.5*TwoS+1)-0.5*TwoS_ladder[:-1]*(0.5*TwoS_ladder[:-1]-1)),k=-1);
+    return read_only(Sz), read_only(Splus), read_only(Sminus);
+
+##################################################################################
+#### operators on the impurity and electron-impurity spaces
+
+@functools.lru_cache(maxsize = None)
+def impurity_ops(TwoS, n_spins, site) -> tuple:
+    '''
+    Sz, S+, S- of impurity number site, on the space of all n_spins impurities
+    '''
+    if(site < 0 or site >= n_spins): raise ValueError;
+    ops = [];
+    for op in spin_matrices(TwoS):
+        for spini in range(n_spins):
+            factor = op if spini == site else np.eye(TwoS+1);
+            op_all = factor if spini == 0 else np.kron(op_all, factor);
+        ops.append(read_only(op_all));
+    return tuple(ops);
+
+@functools.lru_cache(maxsize = None)
+def identity(TwoS, n_spins) -> np.ndarray:
+    '''
+    Identity on the electron-impurity space, of dimension 2(TwoS+1)^n_spins
+    '''
+    return read_only(np.eye(2*(TwoS+1)**n_spins));
+
+@functools.lru_cache(maxsize = None)
+def electron_ops(TwoS, n_spins) -> tuple:
+    '''
+    sz, s+, s- of the electron, on the electron-impurity space
+    '''
+    mol_eye = np.eye((TwoS+1)**n_spins);
+    ops = [np.array([[0.5,0],[0,-0.5]]), np.array([[0,1],[0,0]]), np.array([[0,0],[1,0]])];
+    return tuple([read_only(np.kron(op, mol_eye)) for op in ops]);
+
+@functools.lru_cache(maxsize = None)
+def exchange(TwoS, n_spins, site) -> np.ndarray:
+    '''
+    Heisenberg exchange s.S_site = sz Sz + (s+ S- + s- S+)/2 between the
+    electron and impurity number site, on the electron-impurity space
+    '''
+    Sz, Splus, Sminus = impurity_ops(TwoS, n_spins, site);
+    sz = np.array([[0.5,0],[0,-0.5]]);
+    splus = np.array([[0,1],[0,0]]);
+    sminus = np.array([[0,0],[1,0]]);
+    return read_only(np.kron(sz, Sz) + 0.5*(np.kron(splus, Sminus) + np.kron(sminus, Splus)));
+
+@functools.lru_cache(maxsize = None)
+def zeeman(TwoS, n_spins, site = None) -> np.ndarray:
+    '''
+    Sz of impurity number site (or sz of the electron when site is None),
+    on the electron-impurity space. A field B along z adds B*zeeman(...)
+    '''
+    if(site is None): return electron_ops(TwoS, n_spins)[0];
+    return read_only(np.kron(np.eye(2), impurity_ops(TwoS, n_spins, site)[0]));
+
+@functools.lru_cache(maxsize = None)
+def total_Sz(TwoS, n_spins) -> np.ndarray:
+    '''
+    Total Sz of the electron and all impurities, on the electron-impurity
+    space. Diagonal, so it can be the symmetry of wfm.kernel
+    '''
+    Sz_all = zeeman(TwoS, n_spins, None) + sum([zeeman(TwoS, n_spins, site) for site in range(n_spins)]);
+    return read_only(Sz_all);
@@ -16,7 +16,7 @@ import numpy as np
 ##################################################################################
 #### driver of transmission coefficient calculations
 
-def kernel(h, tnn, tnnn, tl, E, Ajsigma, is_psi_jsigma, is_Rhat, all_debug = True, verbose = 0, ):
+def kernel(h, tnn, tnnn, tl, E, Ajsigma, is_psi_jsigma, is_Rhat, all_debug = True, solver = "rgf", min_run = 16, E_batch = 128, symmetry = None, verbose = 0, ):
     '''
     coefficient for a transmitted up and down electron
     Args
@@ -25,22 +25,56 @@ def kernel(h, tnn, tnnn, tl, E, Ajsigma, is_psi_jsigma, is_Rhat, all_debug = Tru
     -tnnn, array, next nearest neighbor block hopping matrices
     -tl, float, hopping in leads, not necessarily same as hopping on/off SR
         or within SR which is defined by tnn, tnnn matrices
-    -E, float, energy of the incident electron
-    -Ajsigma, incident particle amplitude at site 0 in spin channel j
+    -E, float or 1d array of floats, energy of the incident electron
+    -Ajsigma, incident particle amplitude at site 0 in spin channel j. May
+        be a 2d array with one incident state per column, which are all
+        solved together
     Optional args
     -verbose, how much printing to do
     -is_Rhat, whether to return Rhat operator or just R, T probabilities
     -all_debug, whether to enforce a bunch of extra assert statements
+    -solver, str, how to get the Green's function. "rgf" (default) only
+        computes the block column G[:,0] that is needed, by the recursive
+        Green's function method, in O(N n_loc_dof^3) time (or only G[0,0]
+        when is_Rhat, see Green_surface). "stream" gets only G[0,0] and
+        G[N+1,0], in O(n_loc_dof^2) memory, see Green_stream. "dense" inverts
+        the full E - H' and is kept as a reference
+    -min_run, int, with solver = "rgf", runs of identical sites (eg barriers)
+        with more than min_run interior sites are integrated out by decimation,
+        unless is_psi_jsigma, which needs every site. None turns this off
+    -E_batch, int, when E is an array, max number of energies that are
+        solved together in one stacked (broadcasted) solve. Bounds memory
+    -symmetry, None, "auto", or 2d array. A conserved quantity (eg total Sz
+        of the electron and impurity spins) splits the local dofs into
+        sectors which H never mixes, and each sector is solved as its own,
+        smaller, problem. "auto" finds the sectors from which local dofs are
+        coupled by any block. An array is taken as the conserved operator,
+        which must be diagonal in the local dof basis and commute with all
+        of h, tnn, tnnn. See sectors
 
     Returns
     tuple of R coefs (vector of floats for each sigma) and T coefs (likewise)
     UNLESS is_Rhat = True, in which case
     returns n_loc_dof \times n_loc_dof matrix Rhat, which
     transforms incoming spin states to reflected spin states
+    When E is an array, all of the above are stacked along a new 0th axis
+    which runs over energy. When Ajsigma is 2d, Rs, Ts (and psi_jsigma) get a
+    new last axis which runs over incident states
     '''
     if(not isinstance(h, np.ndarray)): raise TypeError;
     if(not isinstance(tnn, np.ndarray)): raise TypeError;
     if(not isinstance(tnnn, np.ndarray)): raise TypeError;
+    if(np.ndim(E) > 1): raise ValueError;
+
+    # many energies are done in batches
+    if(np.ndim(E) == 1 and len(E) > E_batch):
+        outs = [];
+        for Ei in range(0, len(E), E_batch):
+            outs.append(kernel(h, tnn, tnnn, tl, E[Ei:Ei+E_batch], Ajsigma, is_psi_jsigma, is_Rhat,
+                        all_debug = all_debug, solver = solver, min_run = min_run, E_batch = E_batch, symmetry = symmetry, verbose = verbose));
+        if(isinstance(outs[0], tuple)): # Rs, Ts
+            return tuple([np.concatenate([out[outi] for out in outs]) for outi in range(len(outs[0]))]);
+        return np.concatenate(outs);
     
     # check that lead hams are diagonal
     for hi in [0, -1]: # LL, RL
@@ -48,7 +82,7 @@ def kernel(h, tnn, tnnn, tl, E, Ajsigma, is_psi_jsigma, is_Rhat, all_debug = Tru
         if(all_debug and np.any(isdiag)): # True if there are nonzero off diag terms
             raise Exception("Not diagonal\n"+str(h[hi]))
     for sigma in range(len(Ajsigma)): # always set incident mu = 0
-        if(Ajsigma[sigma] != 0):
+        if(np.any(Ajsigma[sigma] != 0)):
             pass;
             assert(h[0,sigma,sigma] == 0);
 
@@ -56,57 +90,160 @@ def kernel(h, tnn, tnnn, tl, E, Ajsigma, is_psi_jsigma, is_Rhat, all_debug = Tru
     assert( isinstance(Ajsigma, np.ndarray));
     assert( len(Ajsigma) == np.shape(h[0])[0] );
 
+    # green's function
+    if(verbose and np.ndim(E) == 0): print("\nEnergy = {:.6f}".format(np.real(E+2*tl))); # start printouts
+    elif(verbose): print("\nEnergies = {:.6f} ... {:.6f}".format(np.real(E[0]+2*tl), np.real(E[-1]+2*tl)));
+    if(symmetry is None):
+        Gcol = Green_col(h, tnn, tnnn, tl, E, is_psi_jsigma, is_Rhat, solver, min_run, verbose = verbose);
+    else: # solve each symmetry sector on its own
+        n_loc_dof = np.shape(h[0])[0];
+        Gcol = None;
+        for sector in sectors(h, tnn, tnnn, tl, E, symmetry, needed = np.any(np.reshape(Ajsigma != 0, (n_loc_dof, -1)), axis = -1) | is_Rhat, verbose = verbose):
+            ix = np.ix_(sector, sector);
+            Gsector = Green_col(h[:,ix[0],ix[1]], tnn[:,ix[0],ix[1]], tnnn[:,ix[0],ix[1]], tl, E,
+                        is_psi_jsigma, is_Rhat, solver, min_run, verbose = verbose);
+            if(Gcol is None): Gcol = np.zeros(np.shape(Gsector)[:-2]+(n_loc_dof, n_loc_dof), dtype = complex);
+            Gcol[...,ix[0],ix[1]] = Gsector;
+
+    return Green_to_coefs(Gcol, h, tl, E, Ajsigma, is_psi_jsigma, is_Rhat);
+
+def Green_col(h, tnn, tnnn, tl, E, is_psi_jsigma, is_Rhat, solver, min_run, verbose = 0) -> np.ndarray:
+    '''
+    The rows of the 0th block column G[:,0] of the Green's function which
+    kernel needs, by the given solver. Args are as in kernel
+
+    returns G[:,0] with spatial and spin indices separate. When only G[0,0]
+    is needed (Rhat by the "rgf" solver) it is the only row
+    '''
+    if(solver == "rgf" and is_Rhat and not is_psi_jsigma): # only G[0,0] is needed
+        G00 = Green_surface(h, tnn, tnnn, tl, E, min_run = min_run, verbose = verbose);
+        return G00[...,None,:,:];
+    elif(solver == "rgf"): # only the 0th block column is ever needed
+        if(is_psi_jsigma): min_run = None; # need all sites
+        Gmat = Green_RGF(h, tnn, tnnn, tl, E, [0], min_run = min_run, verbose = verbose); # spatial and spin indices separate
+    elif(solver == "dense" and np.ndim(E) == 0):
+        Gmat = Green(h, tnn, tnnn, tl, E, verbose = verbose)[:,:1]; # spatial and spin indices separate
+    elif(solver == "dense"):
+        Gmat = np.array([Green(h, tnn, tnnn, tl, Eval, verbose = verbose)[:,:1] for Eval in E]);
+    elif(solver == "stream"): # only G[0,0], G[N+1,0]
+        if(is_psi_jsigma): raise ValueError("solver = stream does not keep psi_jsigma");
+        width = 2 if np.any(tnnn) else 1;
+        return Green_stream(site_blocks(h, tnn, tnnn), tl, E, width = width, verbose = verbose)[0];
+    else: raise NotImplementedError("solver = "+str(solver)+" not supported");
+    return Gmat[...,:,0,:,:];
+
+def sectors(h, tnn, tnnn, tl, E, symmetry, needed = None, verbose = 0) -> list:
+    '''
+    Split the local dofs into sectors which are never mixed by h, tnn, tnnn
+    Args
+    -h, tnn, tnnn, tl, E are as in kernel
+    -symmetry, "auto" or 2d array. "auto" groups local dofs which are
+        coupled, directly or through others, by any block. An array is a
+        conserved operator, diagonal in the local dof basis, and local dofs
+        are grouped by its eigenvalue
+    -needed, bool vector over local dofs, whose sectors must be solved.
+        Sectors which are closed in the LL at some energy are merged into
+        the first open sector if needed and dropped otherwise, since the
+        self energies need an open LL channel
+
+    returns list of int arrays of local dof indices, one for each sector
+    '''
+    n_loc_dof = np.shape(h[0])[0];
+    if(needed is None): needed = np.ones(n_loc_dof, dtype = bool);
+    needed = np.broadcast_to(needed, (n_loc_dof,));
+
+    # which local dofs the blocks couple
+    coupled = np.eye(n_loc_dof, dtype = bool);
+    for blocks in [h, tnn, tnnn]:
+        if(len(blocks)): coupled = coupled | np.any(blocks != 0, axis = 0);
+    coupled = coupled | coupled.T;
+
+    if(isinstance(symmetry, str) and symmetry == "auto"):
+        from scipy.sparse.csgraph import connected_components
+        _, labels = connected_components(coupled, directed = False);
+    elif(isinstance(symmetry, np.ndarray)):
+        if(np.shape(symmetry) != (n_loc_dof, n_loc_dof)): raise ValueError;
+        if(np.any(symmetry - np.diagflat(np.diagonal(symmetry)))):
+            raise ValueError("conserved operator must be diagonal in the local dof basis");
+        _, labels = np.unique(np.diagonal(symmetry), return_inverse = True);
+        if(np.any(coupled & (labels[:,None] != labels[None,:]))):
+            raise ValueError("operator does not commute with the hamiltonian");
+    else: raise TypeError("symmetry = "+str(symmetry)+" not supported");
+    all_sectors = [np.arange(n_loc_dof)[labels == label] for label in np.unique(labels)];
+
+    # LL channels open at all energies
+    Es = np.real(np.asarray(E))[..., None];
+    is_open = np.all(abs(Es - np.real(np.diagonal(h[0]))) < 2*abs(tl), axis = tuple(range(np.ndim(E))));
+    open_sectors = [sector for sector in all_sectors if np.any(is_open[sector])];
+    closed_sectors = [sector for sector in all_sectors if not np.any(is_open[sector]) and np.any(needed[sector])];
+    if(not open_sectors): return [np.arange(n_loc_dof)]; # nothing to gain
+    if(closed_sectors):
+        open_sectors[0] = np.sort(np.concatenate([open_sectors[0]]+closed_sectors));
+    if(verbose): print("sectors = ", [sector.tolist() for sector in open_sectors]);
+    return open_sectors;
+
+def Green_to_coefs(Gcol, h, tl, E, Ajsigma, is_psi_jsigma, is_Rhat) -> tuple:
+    '''
+    From the 0th block column of the Green's function, get the outputs of kernel
+    Args
+    -Gcol, array, G[:,0] with spatial and spin indices separate. Its rows
+        must include the LL (row 0) and RL (row -1) sites, but when only
+        Rs, Ts or Rhat are wanted, the rows in between can be omitted
+    -h, array, block hamiltonian matrices (only the lead blocks are used)
+    -tl, E, Ajsigma, is_psi_jsigma, is_Rhat are as in kernel
+
+    Returns
+    psi_jsigma, Rhat, or tuple of Rs, Ts as in kernel
+    '''
+
     # unpack
-    N = len(h) - 2; # num scattering region sites
     n_loc_dof = np.shape(h[0])[0];
+    Es = np.asarray(E)[..., None]; # broadcasts against sigma components
 
     # determine velocities in the left, right leads
-    ka_L = np.arccos((E-np.diagonal(h[0]))/(-2*tl)); # vector with sigma components
-    ka_R = np.arccos((E-np.diagonal(h[-1]))/(-2*tl));
+    ka_L = np.arccos((Es-np.diagonal(h[0]))/(-2*tl)); # vector with sigma components
+    ka_R = np.arccos((Es-np.diagonal(h[-1]))/(-2*tl));
     v_L = 2*tl*np.sin(ka_L); # vector with sigma components
     v_R = 2*tl*np.sin(ka_R); # a, hbar defined as 1
-
-    # green's function
-    if(verbose): print("\nEnergy = {:.6f}".format(np.real(E+2*tl))); # start printouts
-    Gmat = Green(h, tnn, tnnn, tl, E, verbose = verbose); # spatial and spin indices separate
     
+    # incident states as columns, so that many are solved together
+    is_1d = (np.ndim(Ajsigma) == 1);
+    Acols = np.reshape(Ajsigma, (n_loc_dof, -1));
+    unpack = lambda arr: arr[...,0] if is_1d else arr;
+
     # from Green's function, determine wavefunction elements \psi_j\sigma
-    psi_jsigma = complex(0,1)*np.dot(Gmat[:,0], Ajsigma*v_L);
-    if(is_psi_jsigma): return psi_jsigma;
+    source = (Acols*v_L[...,:,None])[..., None, :, :]; # broadcasts against sites
+    psi_jsigma = complex(0,1)*np.matmul(Gcol, source);
+    if(is_psi_jsigma): return unpack(psi_jsigma);
     
     # from Green's func, determine matrix elements < \sigma | rhat | \sigma'> of the
     # reflection operator Rhat, which scatters \sigma' -> \sigma
-    Rhat_matrix = 2*tl*complex(0,1)*Gmat[0,0]*np.sin(ka_L) - np.eye(n_loc_dof);
+    Rhat_matrix = 2*tl*complex(0,1)*Gcol[...,0,:,:]*np.sin(ka_L)[...,None,:] - np.eye(n_loc_dof);
     if(is_Rhat): return Rhat_matrix;
 
     # determine matrix elements
-    i_flux = np.sqrt(np.dot(Ajsigma, Ajsigma*np.real(v_L))); # sqrt of i flux
+    i_flux = np.sqrt(np.sum(Acols*Acols*np.real(v_L)[...,:,None], axis=-2))[..., None, :]; # sqrt of i flux
 
     # from matrix elements, determine R and T coefficients
     # (eq:Rcoef and eq:Tcoef in paper)
-    Rs = np.zeros(n_loc_dof, dtype = float); # force as float bc we check that imag part is tiny
-    Ts = np.zeros(n_loc_dof, dtype = float);
-    for sigma in range(n_loc_dof): # iter over spin dofs
-        # sqrt of r flux, numerator of eq:Rcoef in manuscript
-        r_flux = (complex(0,1)*np.dot(Gmat[0,0,sigma], Ajsigma*v_L)-Ajsigma[sigma])*np.sqrt(np.real(v_L[sigma]));
-        r_el = r_flux/i_flux;
-        Rcoef_to_add = r_el*np.conjugate(r_el);
-        if(abs(np.imag(Rcoef_to_add))>1e-10): 
-            print("Imag(Rs[{:.0f}]) = {:.10f}".format(sigma, np.imag(Rcoef_to_add)));
-            assert(abs(np.imag(Rcoef_to_add))<1e-10);
-        Rs[sigma] = np.real(Rcoef_to_add);
-        # sqrt of t flux, numerator of eq:Tcoef in manuscript
-        t_flux = complex(0,1)*np.dot(Gmat[N+1,0,sigma], Ajsigma*v_L)*np.sqrt(np.real(v_R[sigma]));
-        t_el = t_flux/i_flux;
-        Tcoef_to_add = t_el*np.conjugate(t_el);
-        if(abs(np.imag(Tcoef_to_add))>1e-10): 
-            print("Imag(Ts[{:.0f}]) = {:.10f}".format(sigma, np.imag(Tcoef_to_add)));
-            assert(abs(np.imag(Tcoef_to_add))<1e-10);
-        Ts[sigma] = np.real(Tcoef_to_add);
+    # sqrt of r flux, numerator of eq:Rcoef in manuscript
+    r_flux = (psi_jsigma[...,0,:,:]-Acols)*np.sqrt(np.real(v_L))[...,:,None];
+    r_el = r_flux/i_flux;
+    Rcoefs = r_el*np.conjugate(r_el);
+    # sqrt of t flux, numerator of eq:Tcoef in manuscript
+    t_flux = psi_jsigma[...,-1,:,:]*np.sqrt(np.real(v_R))[...,:,None];
+    t_el = t_flux/i_flux;
+    Tcoefs = t_el*np.conjugate(t_el);
+    for coefs, coefs_str in [(Rcoefs, "Rs"), (Tcoefs, "Ts")]: # force as float bc we check that imag part is tiny
+        if(np.any(abs(np.imag(coefs))>1e-10)):
+            print("Imag("+coefs_str+") = ", np.imag(coefs));
+            assert(not np.any(abs(np.imag(coefs))>1e-10));
+    Rs = unpack(np.real(Rcoefs).astype(float));
+    Ts = unpack(np.real(Tcoefs).astype(float));
     
     return Rs, Ts;
 
-def Hmat(h, tnn, tnnn, verbose = 0) -> np.ndarray:
+def Hmat(h, tnn, tnnn, is_sparse = False, verbose = 0) -> np.ndarray:
     '''
     Make the hamiltonian H for reduced dimensional N+2 x N+2 system
     where there are N sites in the scattering region (SR), 1 LL site, 1 RL site
@@ -114,6 +251,9 @@ def Hmat(h, tnn, tnnn, verbose = 0) -> np.ndarray:
     -h, 2d array, on site blocks at each of the N+2 sites of the system
     -tnn, 2d array, nearest neighbor hopping btwn sites, N-1 blocks
     -tnnn, 2d array, next nearest neighbor hopping btwn sites, N-2 blocks
+    Optional args
+    -is_sparse, whether to return a scipy.sparse.bsr_matrix with
+        n_loc_dof x n_loc_dof blocks instead of a dense array
 
     returns 2d array with spatial and spin indices mixed
     '''
@@ -123,36 +263,36 @@ def Hmat(h, tnn, tnnn, verbose = 0) -> np.ndarray:
     # unpack
     N = len(h) - 2; # num scattering region sites
     n_loc_dof = np.shape(h[0])[0]; # general dofs that are not the site number
-    H =  np.zeros((n_loc_dof*(N+2), n_loc_dof*(N+2) ), dtype = complex);
     # outer shape: num sites x num sites (0 <= j <= N+1)
     # shape at each site: n_loc_dof, runs over all other degrees of freedom
 
-    # construct H
-    for sitei in range(0,N+2): # iter site dof only
-        for sitej in range(0,N+2): # same
-                
-            for loci in range(np.shape(h[0])[0]): # iter over local dofs
-                for locj in range(np.shape(h[0])[0]):
-
-                    # site, loc indices -> overall indices
-                    ovi = sitei*n_loc_dof + loci;
-                    ovj = sitej*n_loc_dof + locj;
-
-                    if(sitei == sitej): # input from local h to main diag
-                        H[ovi, ovj] = h[sitei][loci, locj];
+    # H is block pentadiagonal. (offset, blocks) for each block diagonal
+    js = np.arange(N+2);
+    diagonals = [(0, h), (-1, tnn), (1, tnn), (-2, tnnn), (2, tnnn)];
 
-                    elif(sitei == sitej+1): # input from tnn to lower diag
-                        H[ovi, ovj] = tnn[sitej][loci, locj];
+    if(is_sparse): # scatter blocks into block sparse row format
+        from scipy.sparse import bsr_matrix
+        rows, cols, data = [], [], [];
+        for offset, blocks in diagonals:
+            if(len(blocks) == 0): continue;
+            rows.append(js[max(0,-offset):N+2-max(0,offset)]);
+            cols.append(rows[-1] + offset);
+            data.append(np.asarray(blocks, dtype = complex));
+        rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data);
+        order = np.lexsort((cols, rows));
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength = N+2))));
+        return bsr_matrix((data[order], cols[order], indptr),
+                    shape = (n_loc_dof*(N+2), n_loc_dof*(N+2)), blocksize = (n_loc_dof, n_loc_dof));
 
-                    elif(sitei+1 == sitej): # input from tnn to upper diag
-                        H[ovi, ovj] = tnn[sitei][loci, locj];
+    # construct H with spatial and spin indices separate, by slicing
+    H = np.zeros((N+2, N+2, n_loc_dof, n_loc_dof), dtype = complex);
+    for offset, blocks in diagonals:
+        if(len(blocks) == 0): continue;
+        sitei = js[max(0,-offset):N+2-max(0,offset)];
+        H[sitei, sitei+offset] = blocks;
 
-                    elif(sitei == sitej+2): # input from tnnn to 2nd lower diag
-                        H[ovi, ovj] = tnnn[sitej][loci, locj];
-
-                    elif(sitei+2 == sitej): # input from tnnn to 2nd upper diag
-                        H[ovi, ovj] = tnnn[sitei][loci, locj];
-                        
+    # site, loc indices -> overall indices
+    H = np.transpose(H, (0,2,1,3)).reshape(n_loc_dof*(N+2), n_loc_dof*(N+2));
     return H; # end Hmat
 
 def Hprime(h, tnn, tnnn, tl, E, verbose = 0) -> np.ndarray:
@@ -175,46 +315,60 @@ def Hprime(h, tnn, tnnn, tl, E, verbose = 0) -> np.ndarray:
     # base hamiltonian
     Hp = Hmat(h, tnn, tnnn, verbose = verbose); # SR on site, hopping blocks
     
+    # self energies in LL, RL
+    SigmaLs, SigmaRs = self_energies(h, tl, E, verbose = verbose);
+    for Vi in range(n_loc_dof): # iters over all local dof
+        Hp[Vi,Vi] += SigmaLs[Vi];
+        Hp[Vi-n_loc_dof,Vi-n_loc_dof] += SigmaRs[Vi];
+
+    return Hp;
+
+def self_energies(h, tl, E, verbose = 0) -> tuple:
+    '''
+    Self energies of the left lead (LL) and right lead (RL), which are
+    added to the diagonal of the 0th and N+1th on site blocks to make H'
+    Args
+    -h, array, on site blocks at each of the N+2 sites of the system
+    -tl, float, hopping in leads
+    -E, float or 1d array of floats, incident energy
+
+    returns tuple of SigmaLs, SigmaRs, complex vectors running over local dofs
+    (stacked along a 0th energy axis when E is an array)
+    '''
+
+    # unpack
+    n_loc_dof = np.shape(h[0])[0]; # general dofs that are not the site number
+
     # self energies in LL
     # need a self energy for all incoming/outgoing spin states (all local dof)
-    SigmaLs = np.zeros(n_loc_dof, dtype = complex);
-    for Vi in range(n_loc_dof): # iters over all local dof
-        # scale the energy
-        V = h[0][Vi,Vi];
-        lamL = (E-V)/(-2*tl);
-        # make sure sign of SigmaL is correctly assigned
-        assert( abs(np.imag(lamL)) < 1e-10);
-        lamL = np.real(lamL);
-        # reflected self energy
-        LambdaLminus = lamL - np.lib.scimath.sqrt(lamL*lamL - 1); 
-        SigmaL = -tl/LambdaLminus; 
-        Hp[Vi,Vi] += SigmaL;
-        SigmaLs[Vi] = SigmaL
-    del V, lamL, LambdaLminus, SigmaL
+    # energies broadcast against the local dofs
+    Es = np.asarray(E)[..., None];
+    # scale the energy
+    lamL = (Es-np.diagonal(h[0]))/(-2*tl);
+    # make sure sign of SigmaL is correctly assigned
+    assert( np.all(abs(np.imag(lamL)) < 1e-10));
+    lamL = np.real(lamL);
+    # reflected self energy
+    LambdaLminus = lamL - np.lib.scimath.sqrt(lamL*lamL - 1); 
+    SigmaLs = (-tl/LambdaLminus).astype(complex);
+    del lamL, LambdaLminus;
 
     # self energies in RL
-    SigmaRs = np.zeros(n_loc_dof, dtype = complex);
-    for Vi in range(n_loc_dof): # iters over all local dof
-        # scale the energy
-        V = h[-1][Vi,Vi];     
-        lamR = (E-V)/(-2*tl);
-        # make sure the sign of SigmaR is correctly assigned
-        assert( abs(np.imag(lamR)) < 1e-10);
-        lamR = np.real(lamR); # makes sure sign of SigmaL is correctly assigned
-        # transmitted self energy
-        LambdaRplus = lamR + np.lib.scimath.sqrt(lamR*lamR - 1);
-        SigmaR = -tl*LambdaRplus;
-        Hp[Vi-n_loc_dof,Vi-n_loc_dof] += SigmaR;
-        SigmaRs[Vi] = SigmaR;
-    del V, lamR, LambdaRplus, SigmaR;
+    # scale the energy
+    lamR = (Es-np.diagonal(h[-1]))/(-2*tl);
+    # make sure the sign of SigmaR is correctly assigned
+    assert( np.all(abs(np.imag(lamR)) < 1e-10));
+    lamR = np.real(lamR);
+    # transmitted self energy
+    LambdaRplus = lamR + np.lib.scimath.sqrt(lamR*lamR - 1);
+    SigmaRs = (-tl*LambdaRplus).astype(complex);
+    del lamR, LambdaRplus;
 
     # check that modes with given energy are allowed in some LL channels
-    SigmaLs, SigmaRs = np.array(SigmaLs), np.array(SigmaRs);
-    assert(np.any(np.imag(SigmaLs)) );
-    for sigmai in range(len(SigmaLs)):
-        if(abs(np.imag(SigmaLs[sigmai])) > 1e-10 and abs(np.imag(SigmaRs[sigmai])) > 1e-10 ):
-            assert(np.sign(np.imag(SigmaLs[sigmai])) == np.sign(np.imag(SigmaRs[sigmai])));
-    if(verbose > 3):
+    assert(np.all(np.any(np.imag(SigmaLs), axis=-1)) );
+    both_open = np.logical_and(abs(np.imag(SigmaLs)) > 1e-10, abs(np.imag(SigmaRs)) > 1e-10);
+    assert(np.all((np.sign(np.imag(SigmaLs)) == np.sign(np.imag(SigmaRs)))[both_open]));
+    if(verbose > 3 and np.ndim(E) == 0):
         ka_L = np.arccos((E-np.diagonal(h[0]))/(-2*tl)); # vector running over sigma
         ka_R = np.arccos((E-np.diagonal(h[-1]))/(-2*tl));
         v_L = 2*tl*np.sin(ka_L); # a/hbar defined as 1
@@ -225,7 +379,7 @@ def Hprime(h, tnn, tnnn, tl, E, verbose = 0) -> np.ndarray:
             print(" - sigma = "+str(sigma)+", v_R = {:.4f}+{:.4f}j, Sigma_R = {:.4f}+{:.4f}j"
                   .format(np.real(v_R[sigma]), np.imag(v_R[sigma]), np.real(SigmaRs[sigma]), np.imag(SigmaRs[sigma])));
 
-    return Hp;
+    return SigmaLs, SigmaRs;
 
 def Green(h, tnn, tnnn, tl, E, verbose = 0) -> np.ndarray:
     '''
@@ -254,6 +408,995 @@ def Green(h, tnn, tnnn, tl, E, verbose = 0) -> np.ndarray:
     Gmat = fci_mod.mat_2d_to_4d(Gmat, n_loc_dof); # separates spatial and spin indices
     return Gmat;
 
+def bond_currents(psi, tnn, tnnn) -> np.ndarray:
+    '''
+    Particle current of the wavefunction psi across the cut between sites j
+    and j+1, resolved by the local dof sigma of the site it flows into,
+    J_{j \to j+1, \sigma} = 2 Im( psi_{j+1,\sigma}^* (H_{j+1,j} psi_j)_\sigma )
+    plus the next nearest neighbor hops which cross the same cut
+    Args
+    -psi, array, wavefunction with spatial and spin indices separate, as
+        returned by kernel(..., is_psi_jsigma = True). May be stacked over energy
+    -tnn, tnnn, hopping blocks as in kernel
+
+    returns array of shape (N+1, n_loc_dof)
+    '''
+
+    # nearest neighbor hops j -> j+1, H_{j+1,j} = tnn[j]
+    hopped = np.einsum("jab,...jb->...ja", tnn, psi[...,:-1,:]);
+    currents = 2*np.imag(np.conj(psi[...,1:,:])*hopped);
+
+    # next nearest neighbor hops j -> j+2 cross cuts j and j+1
+    if(np.any(tnnn)):
+        hopped = np.einsum("jab,...jb->...ja", tnnn, psi[...,:-2,:]);
+        nnn_currents = 2*np.imag(np.conj(psi[...,2:,:])*hopped);
+        currents[...,:-1,:] += nnn_currents;
+        currents[...,1:,:] += nnn_currents;
+    return currents;
+
+def Hblock(h, tnn, tnnn, sitei, sitej) -> np.ndarray:
+    '''
+    The n_loc_dof x n_loc_dof block of H between sites sitei and sitej,
+    following the same conventions as Hmat
+    '''
+    if(sitei == sitej): # local h on main diag
+        return h[sitei];
+    elif(sitei == sitej+1): # tnn on lower diag
+        return tnn[sitej];
+    elif(sitei+1 == sitej): # tnn on upper diag
+        return tnn[sitei];
+    elif(sitei == sitej+2): # tnnn on 2nd lower diag
+        return tnnn[sitej];
+    elif(sitei+2 == sitej): # tnnn on 2nd upper diag
+        return tnnn[sitei];
+    else:
+        return np.zeros_like(h[0]);
+
+def supersites(h, tnn, tnnn, verbose = 0) -> tuple:
+    '''
+    Group the N+2 sites into supersites such that H is block tridiagonal in
+    the supersites. When there is no next nearest neighbor hopping, every site
+    is its own supersite. Otherwise sites are grouped in pairs, and the last
+    supersite may be a single site
+    Args
+    -h, array, on site blocks at each of the N+2 sites of the system
+    -tnn, array, nearest neighbor hopping btwn sites, N+1 blocks
+    -tnnn, array, next nearest neighbor hopping btwn sites, N blocks
+
+    returns tuple of
+    -list of site index arrays belonging to each supersite
+    -list of on site supersite blocks of H
+    -list of upper (K, K+1) supersite hopping blocks of H
+    -list of lower (K+1, K) supersite hopping blocks of H
+    '''
+    if(not len(tnn) +1 == len(h)): raise ValueError;
+    if(not len(tnnn)+2 == len(h)): raise ValueError;
+
+    # group sites
+    n_sites = len(h);
+    width = 1;
+    if(np.any(tnnn)): width = 2;
+    groups = [np.arange(j, min(j+width, n_sites)) for j in range(0, n_sites, width)];
+    if(width == 1): # blocks are just those of the sites
+        h, tnn = np.asarray(h, dtype = complex), np.asarray(tnn, dtype = complex);
+        return groups, list(h), list(tnn), list(tnn);
+
+    # fill supersite blocks
+    def superblock(groupi, groupj):
+        block = np.zeros((len(groupi)*len(h[0]), len(groupj)*len(h[0])), dtype = complex);
+        n_loc_dof = len(h[0]);
+        for i in range(len(groupi)):
+            for j in range(len(groupj)):
+                block[i*n_loc_dof:(i+1)*n_loc_dof, j*n_loc_dof:(j+1)*n_loc_dof] = Hblock(h, tnn, tnnn, groupi[i], groupj[j]);
+        return block;
+    diags, uppers, lowers = [], [], [];
+    for K in range(len(groups)):
+        diags.append(superblock(groups[K], groups[K]));
+        if(K+1 < len(groups)):
+            uppers.append(superblock(groups[K], groups[K+1]));
+            lowers.append(superblock(groups[K+1], groups[K]));
+    if(verbose > 3): print("supersite widths = ", [len(group) for group in groups]);
+
+    return groups, diags, uppers, lowers;
+
+def Green_RGF(h, tnn, tnnn, tl, E, cols, min_run = None, verbose = 0) -> np.ndarray:
+    '''
+    Block columns of the Greens function, by the recursive Green's function
+    (block Thomas) algorithm acting on the supersite blocks of E - H'.
+    Costs O(N n_loc_dof^3) time and O(N n_loc_dof^2) memory, rather than
+    the O((N n_loc_dof)^3) time of inverting E - H' as in Green
+    Args
+    -h, array, on site blocks at each of the N+2 sites of the system
+    -tnn, array, nearest neighbor hopping btwn sites, N+1 blocks
+    -tnnn, array, next nearest neighbor hopping btwn sites, N blocks
+    -tl, float, hopping in leads, distinct from hopping within SR def'd by above arrays
+    -E, float or 1d array of floats, incident energy
+    -cols, list of ints, site indices j of the block columns G[:,j] to compute
+    Optional args
+    -min_run, int, if not None, runs of identical supersites (same on site
+        and hopping blocks, eg a barrier) with at least min_run interior
+        supersites are integrated out by decimation, in O(log(run length))
+        block operations. This is only done when E is gapped away from the
+        band of the run (E - h is block diagonally dominant), since otherwise
+        finite pieces of the run can be resonant at E. The rows of G at the interior sites of these runs
+        are not computed and are returned as nan
+
+    returns 4d array with spatial and spin indices separate, s.t.
+    return[:,k] is G[:,cols[k]]. When E is an array, the energies are solved
+    together by broadcasting and stacked along a new 0th axis
+    '''
+    if(not isinstance(h, np.ndarray)): raise TypeError;
+
+    # unpack
+    N = len(h) - 2; # num scattering region sites
+    n_loc_dof = np.shape(h[0])[0];
+    n_cols = len(cols);
+    groups, kept, Ablocks, Cups, Clows = reduced_blocks(h, tnn, tnnn, tl, E, min_run = min_run, verbose = verbose);
+
+    # right hand side: unit block columns at the requested sites
+    supersite_of = np.full((N+2,), -1, dtype=int);
+    for Ki in range(len(kept)): supersite_of[groups[kept[Ki]]] = Ki;
+    Bblocks = [np.zeros((len(groups[K])*n_loc_dof, n_cols*n_loc_dof), dtype = complex) for K in kept];
+    for coli in range(n_cols):
+        Ki = supersite_of[cols[coli]];
+        if(Ki < 0): raise ValueError("site "+str(cols[coli])+" was decimated");
+        j = cols[coli] - groups[kept[Ki]][0];
+        Bblocks[Ki][j*n_loc_dof:(j+1)*n_loc_dof, coli*n_loc_dof:(coli+1)*n_loc_dof] = np.eye(n_loc_dof);
+
+    # solve
+    Xblocks = block_tridiag_solve(Ablocks, Cups, Clows, Bblocks);
+
+    # make 4d
+    Gcols = np.full(np.shape(E)+(N+2, n_cols, n_loc_dof, n_loc_dof), np.nan, dtype = complex);
+    for Ki in range(len(kept)):
+        group = groups[kept[Ki]];
+        for j in range(len(group)):
+            for coli in range(n_cols):
+                Gcols[...,group[j], coli,:,:] = Xblocks[Ki][...,j*n_loc_dof:(j+1)*n_loc_dof, coli*n_loc_dof:(coli+1)*n_loc_dof];
+    return Gcols;
+
+def reduced_blocks(h, tnn, tnnn, tl, E, min_run = None, verbose = 0) -> tuple:
+    '''
+    The supersite blocks of E - H', with the lead self energies included,
+    after integrating out uniform runs of supersites (see Green_RGF)
+    Args
+    -h, tnn, tnnn, tl, E, min_run are as in Green_RGF
+
+    returns tuple of
+    -list of site index arrays belonging to each supersite
+    -list of the supersites K that are kept
+    -list of on site blocks A[K,K] of the kept supersites
+    -list of hopping blocks A[K,K'] to the next kept supersite K'
+    -list of hopping blocks A[K',K] from the next kept supersite K'
+    '''
+
+    # unpack
+    n_loc_dof = np.shape(h[0])[0];
+    groups, diags, uppers, lowers = supersites(h, tnn, tnnn, verbose = verbose);
+
+    # find uniform runs to decimate, leaving only their end supersites
+    # only runs whose E - H' is block diagonally dominant at all the energies,
+    # ie E is gapped away from the band of the run, can be decimated stably
+    SigmaLs, SigmaRs = self_energies(h, tl, E, verbose = verbose);
+    Es = np.asarray(E)[..., None, None];
+    runs = [];
+    if(min_run is not None):
+        for K0, K1 in uniform_runs(diags, uppers, lowers, min_run):
+            smallest = np.linalg.svd(Es*np.eye(len(diags[K0])) - diags[K0], compute_uv = False)[...,-1];
+            if(np.all(smallest > np.linalg.norm(uppers[K0], 2) + np.linalg.norm(lowers[K0], 2))):
+                runs.append((K0, K1));
+        if(verbose > 3): print("decimated runs = ", runs);
+    kept = list(range(len(groups)));
+    for K0, K1 in runs[::-1]: # last to first so that indices into kept stay valid
+        kept = kept[:K0+1] + kept[K1:];
+
+    # E - H' blocks of the kept supersites, with self energies at the ends
+    # energies, if more than one, are stacked along the 0th axis of every block
+    Ablocks = {K:Es*np.eye(len(diags[K])) - diags[K] for K in kept};
+    Ablocks[0][...,:n_loc_dof,:n_loc_dof] -= SigmaLs[...,None]*np.eye(n_loc_dof);
+    Ablocks[kept[-1]][...,-n_loc_dof:,-n_loc_dof:] -= SigmaRs[...,None]*np.eye(n_loc_dof);
+    Cups = {K:-uppers[K] for K in kept[:-1]}; # E - H' between K and the next kept supersite
+    Clows = {K:-lowers[K] for K in kept[:-1]}; # E - H' between the next kept supersite and K
+
+    # integrate out the interior of the runs
+    for K0, K1 in runs:
+        alpha, beta, gamma, delta = decimate(Es*np.eye(len(diags[K0])) - diags[K0], -uppers[K0], -lowers[K0], K1-K0);
+        Ablocks[K0] = Ablocks[K0] + alpha;
+        Ablocks[K1] = Ablocks[K1] + beta;
+        Cups[K0], Clows[K0] = gamma, delta; # K0 now couples directly to K1
+    Ablocks = [Ablocks[K] for K in kept];
+    Cups = [Cups[K] for K in kept[:-1]];
+    Clows = [Clows[K] for K in kept[:-1]];
+
+    return groups, kept, Ablocks, Cups, Clows;
+
+def Green_surface(h, tnn, tnnn, tl, E, min_run = None, verbose = 0) -> np.ndarray:
+    '''
+    The surface Greens function G[0,0], which is all that Rhat needs.
+    The system is folded from the right edge into a single self energy on
+    site 0 by a backward Schur complement sweep, in O(N) time. Only the
+    current right connected Greens function is kept during the sweep
+    Args
+    -h, tnn, tnnn, tl, E, min_run are as in Green_RGF
+
+    returns 2d array G[0,0] (stacked along a 0th energy axis when E is an array)
+    '''
+    if(not isinstance(h, np.ndarray)): raise TypeError;
+
+    # unpack
+    n_loc_dof = np.shape(h[0])[0];
+    _, _, Ablocks, Cups, Clows = reduced_blocks(h, tnn, tnnn, tl, E, min_run = min_run, verbose = verbose);
+
+    # right connected greens function, swept from the right edge to site 0
+    gR = np.linalg.inv(Ablocks[-1]);
+    for K in range(len(Ablocks)-2, -1, -1):
+        gR = np.linalg.inv(Ablocks[K] - np.matmul(Cups[K], np.matmul(gR, Clows[K])));
+
+    # site 0 is the first n_loc_dof of supersite 0
+    return gR[...,:n_loc_dof,:n_loc_dof];
+
+def block_tridiag_solve(Ablocks, Cups, Clows, Bblocks) -> list:
+    '''
+    Solve A X = B for block tridiagonal A by the recursive Green's function
+    (block Thomas) algorithm. Blocks may be stacked along leading axes, eg
+    energy, which are broadcast
+    Args
+    -Ablocks, list of the diagonal blocks A[K,K]
+    -Cups, list of the upper blocks A[K,K+1]
+    -Clows, list of the lower blocks A[K+1,K]
+    -Bblocks, list of the blocks B[K] of the right hand side
+
+    returns list of the blocks X[K] of the solution
+    '''
+    if(not (len(Ablocks) == len(Cups)+1 == len(Clows)+1 == len(Bblocks))): raise ValueError;
+    gLs = block_tridiag_factor(Ablocks, Cups, Clows);
+    return block_tridiag_back(gLs, Cups, Clows, Bblocks);
+
+def block_tridiag_factor(Ablocks, Cups, Clows) -> list:
+    '''
+    Forward sweep of block_tridiag_solve, which does not depend on the
+    right hand side. Args are as in block_tridiag_solve
+
+    returns list of the left connected greens functions gL_K, ie the inverse of
+    the K,K block of the Schur complement of A onto supersites K, K+1, ...
+    '''
+    gLs = [np.linalg.inv(Ablocks[0])];
+    for K in range(1, len(Ablocks)):
+        gLs.append(np.linalg.inv(Ablocks[K] - np.matmul(Clows[K-1], np.matmul(gLs[K-1], Cups[K-1]))));
+    return gLs;
+
+def block_tridiag_back(gLs, Cups, Clows, Bblocks) -> list:
+    '''
+    Solve A X = B given the left connected greens functions gL_K of A
+    from block_tridiag_factor. Other args are as in block_tridiag_solve
+
+    returns list of the blocks X[K] of the solution
+    '''
+
+    # forward sweep of the right hand side
+    Yblocks = [Bblocks[0]];
+    for K in range(1, len(gLs)):
+        Yblocks.append(Bblocks[K] - np.matmul(Clows[K-1], np.matmul(gLs[K-1], Yblocks[K-1])));
+
+    # backward sweep for the solution
+    Xblocks = [None for _ in gLs];
+    Xblocks[-1] = np.matmul(gLs[-1], Yblocks[-1]);
+    for K in range(len(gLs)-2, -1, -1):
+        Xblocks[K] = np.matmul(gLs[K], Yblocks[K] - np.matmul(Cups[K], Xblocks[K+1]));
+    return Xblocks;
+
+def site_blocks(h, tnn, tnnn):
+    '''
+    Generator of the tuples (h[j], tnn[j], tnnn[j]) over sites j, the form
+    of blocks streamed by Green_stream. Hoppings past the RL are None
+    '''
+    for j in range(len(h)):
+        yield h[j], (tnn[j] if j < len(tnn) else None), (tnnn[j] if j < len(tnnn) else None);
+
+def Green_stream(blocks, tl, E, width = 1, verbose = 0) -> tuple:
+    '''
+    G[0,0] and G[N+1,0], which are all that Rs, Ts and Rhat need, by one
+    forward sweep over the sites which only ever keeps the left connected
+    greens functions gL[K,K], gL[K,0], gL[0,K], gL[0,0] of the current
+    supersite K. So memory is O(n_loc_dof^2), independent of N, and the
+    blocks can come from a generator, eg for long or disordered regions
+    which are never materialized. This is the stable form of multiplying
+    transfer matrices across the region, since evanescent modes never grow
+    Args
+    -blocks, iterable of tuples (h[j], tnn[j], tnnn[j]) over the N+2 sites
+        j, in order from the LL to the RL, as from site_blocks. Hoppings
+        past the RL can be None, and tnnn can be None throughout if width = 1
+    -tl, E are as in kernel
+    -width, int, sites per supersite, 2 if there is any next nearest
+        neighbor hopping
+
+    returns tuple of G[[0,N+1],0] (spatial and spin indices separate) and the
+    lead blocks h[[0,N+1]], which can be passed to Green_to_coefs
+    '''
+    sites = iter(blocks);
+
+    def next_group():
+        group = [];
+        for item in sites:
+            group.append(tuple([np.zeros_like(item[0]) if blk is None else blk for blk in item]));
+            if(len(group) == width): break;
+        return group;
+
+    def superblock(local, rows, cols): # H between local sites, see Hblock
+        h_loc, tnn_loc, tnnn_loc = [[item[blocki] for item in local] for blocki in range(3)];
+        if(len(rows) == 1 and len(cols) == 1): return Hblock(h_loc, tnn_loc, tnnn_loc, rows[0], cols[0]);
+        return np.block([[Hblock(h_loc, tnn_loc, tnnn_loc, sitei, sitej) for sitej in cols] for sitei in rows]);
+
+    # first supersite holds the LL
+    group = next_group();
+    if(not group): raise ValueError("no sites");
+    h_LL = group[0][0];
+    n_loc_dof = np.shape(h_LL)[0];
+    dofs = np.arange(n_loc_dof);
+    SigmaLs, _ = self_energies(np.array([h_LL, h_LL]), tl, E);
+    Es = np.asarray(E)[..., None, None];
+
+    K = 0;
+    while(group):
+        next_grp = next_group();
+        n_sites = len(group);
+        A = (Es*np.eye(n_sites*n_loc_dof) - superblock(group, range(n_sites), range(n_sites))).astype(complex);
+        if(K == 0): A[...,dofs,dofs] -= SigmaLs;
+        if(not next_grp): # this supersite holds the RL
+            h_RL = group[-1][0];
+            _, SigmaRs = self_energies(np.array([h_LL, h_RL]), tl, E);
+            A[...,dofs-n_loc_dof,dofs-n_loc_dof] -= SigmaRs;
+
+        # left connected greens functions, including supersite K
+        if(K == 0):
+            gKK = np.linalg.inv(A);
+            gK0, g0K, g00 = gKK[...,:,:n_loc_dof], gKK[...,:n_loc_dof,:], gKK[...,:n_loc_dof,:n_loc_dof];
+        else:
+            gKK = np.linalg.inv(A - np.matmul(low, np.matmul(gKK, up)));
+            g0K_up = np.matmul(g0K, up);
+            g00 = g00 + np.matmul(g0K_up, np.matmul(gKK, np.matmul(low, gK0)));
+            gK0 = np.matmul(gKK, np.matmul(low, gK0));
+            g0K = np.matmul(g0K_up, gKK);
+
+        # couplings to the next supersite
+        if(next_grp):
+            local = group + next_grp;
+            up = superblock(local, range(n_sites), range(n_sites, len(local)));
+            low = superblock(local, range(n_sites, len(local)), range(n_sites));
+        group = next_grp;
+        K += 1;
+    if(verbose): print("Green_stream: {:.0f} supersites".format(K));
+
+    Gcol = np.stack([g00, gK0[...,-n_loc_dof:,:]], axis = -3);
+    return Gcol, np.array([h_LL, h_RL]);
+
+def kernel_stream(blocks, tl, E, Ajsigma, is_Rhat, width = 1, verbose = 0):
+    '''
+    Rs, Ts (or Rhat) as in kernel, from a stream of site blocks, see
+    Green_stream. psi_jsigma is not available since no site is kept
+    '''
+    Gcol, h_leads = Green_stream(blocks, tl, E, width = width, verbose = verbose);
+    return Green_to_coefs(Gcol, h_leads, tl, E, Ajsigma, False, is_Rhat);
+
+def uniform_runs(diags, uppers, lowers, min_run) -> list:
+    '''
+    Find runs of identical supersites, ie supersites K0 ... K1 which all have
+    the same on site block and are all joined by the same hopping blocks.
+    The first and last supersites (which carry the lead self energies) are
+    never part of a run.
+    Args
+    -diags, uppers, lowers, supersite blocks as returned by supersites
+    -min_run, int, minimum number of interior supersites K0 < K < K1
+
+    returns list of (K0, K1) tuples
+    '''
+    n_inner = len(diags) - 2; # supersites 1 ... len(diags)-2
+    if(n_inner < min_run + 2): return [];
+
+    # compare neighbors all at once. Inner supersites all have the same size
+    inner = np.array(diags[1:-1]);
+    same_site = np.all(inner[1:] == inner[:-1], axis=(-2,-1)); # [K-1] is K+1 vs K
+    bonds_up, bonds_low = np.array(uppers[1:n_inner]), np.array(lowers[1:n_inner]);
+    same_bond = np.logical_and(np.all(bonds_up[1:] == bonds_up[:-1], axis=(-2,-1)),
+                               np.all(bonds_low[1:] == bonds_low[:-1], axis=(-2,-1))); # [K-2] is bond K vs K-1
+
+    runs = [];
+    K0 = 1;
+    while(K0 < len(diags) - 2):
+        K1 = K0;
+        while(K1+1 < len(diags) - 1 and same_site[K1-1] and (K1 == K0 or same_bond[K1-2])):
+            K1 += 1;
+        if(K1 - K0 - 1 >= min_run): runs.append((K0, K1));
+        K0 = max(K1, K0+1);
+    return runs;
+
+def decimate(A0, C0up, C0low, n_bonds) -> tuple:
+    '''
+    Integrate out the interior of a uniform chain of n_bonds+1 supersites,
+    each with on site block A0 of E - H and joined by blocks C0up (K,K+1)
+    and C0low (K+1,K), by renormalization decimation (interval doubling).
+    Costs O(log n_bonds) block operations
+    Args
+    -A0, on site block of E - H, may be stacked over energy
+    -C0up, C0low, hopping blocks of E - H
+    -n_bonds, int, number of bonds in the chain
+
+    returns tuple of
+    -alpha, correction to the E - H block of the first supersite
+    -beta, correction to the E - H block of the last supersite
+    -gamma, effective E - H block from the first to the last supersite
+    -delta, effective E - H block from the last to the first supersite
+    '''
+    if(n_bonds < 1): raise ValueError;
+
+    def join(P, Q):
+        # segments P and Q share one supersite, which is eliminated
+        alphaP, betaP, gammaP, deltaP = P;
+        alphaQ, betaQ, gammaQ, deltaQ = Q;
+        g = np.linalg.inv(A0 + betaP + alphaQ);
+        return (alphaP - np.matmul(gammaP, np.matmul(g, deltaP)),
+                betaQ - np.matmul(deltaQ, np.matmul(g, gammaQ)),
+                -np.matmul(gammaP, np.matmul(g, gammaQ)),
+                -np.matmul(deltaQ, np.matmul(g, deltaP)));
+
+    # a single bond has no interior
+    zero = np.zeros_like(A0);
+    power = (zero, zero, C0up + zero, C0low + zero);
+
+    # binary decomposition of n_bonds
+    segment = None;
+    while(n_bonds):
+        if(n_bonds & 1):
+            if(segment is None): segment = power;
+            else: segment = join(segment, power);
+        n_bonds >>= 1;
+        if(n_bonds): power = join(power, power);
+    return segment;
+
+def kernel_spatial(h, tnn, tnnn, tl, E, Ajsigma, E_batch = 32, verbose = 0) -> tuple:
+    '''
+    Spatially resolved observables along the chain: the local density of
+    states, and the bond currents of the scattering state psi_jsigma, from
+    the forward and backward recursive sweeps of ScatteringSystem, so in
+    O(N) memory and without any dense inverse
+    Args
+    -h, tnn, tnnn, tl, E, Ajsigma are as in kernel
+    -E_batch, int, when E is an array, max number of energies that are
+        solved together. Memory is O(E_batch N n_loc_dof^2)
+
+    returns tuple of
+    -LDOS, array of shape (N+2, n_loc_dof), see ScatteringSystem.ldos
+    -bond currents, array of shape (N+1, n_loc_dof), see bond_currents, with
+        a new last axis over incident states when Ajsigma is 2d
+    both stacked along a 0th energy axis when E is an array
+    '''
+    if(np.ndim(E) == 1 and len(E) > E_batch):
+        outs = [kernel_spatial(h, tnn, tnnn, tl, E[Ei:Ei+E_batch], Ajsigma, E_batch = E_batch, verbose = verbose)
+                for Ei in range(0, len(E), E_batch)];
+        return tuple([np.concatenate([out[outi] for out in outs]) for outi in range(2)]);
+    system = ScatteringSystem(h, tnn, tnnn, tl, E, verbose = verbose);
+    return system.ldos(), system.bond_currents(Ajsigma);
+
+class ScatteringSystem():
+    def __init__(self, h, tnn, tnnn, tl, E, verbose = 0):
+        '''
+        Factorization of E - H' for one geometry and energy, from which
+        Rs/Ts, Rhat, wavefunctions, the local density of states and bond
+        currents are all got lazily, without redoing H' or the Green's function
+
+        Args
+        -h, tnn, tnnn, tl are as in kernel
+        -E, float or 1d array of floats, incident energies. For an array, all
+            outputs are stacked along a 0th energy axis
+        '''
+        if(not isinstance(h, np.ndarray)): raise TypeError;
+        if(not isinstance(tnn, np.ndarray)): raise TypeError;
+        if(not isinstance(tnnn, np.ndarray)): raise TypeError;
+
+        # factorize once, keeping every site
+        self.groups, _, self.Ablocks, self.Cups, self.Clows = reduced_blocks(h, tnn, tnnn, tl, E, verbose = verbose);
+        self.gLs = block_tridiag_factor(self.Ablocks, self.Cups, self.Clows);
+        self.h, self.tnn, self.tnnn, self.tl, self.E = h, tnn, tnnn, tl, E;
+        self.n_loc_dof = np.shape(h[0])[0];
+
+        # filled in when first needed
+        self.Gcol = None;
+        self.Gdiag = None;
+
+    def Green_col(self) -> np.ndarray:
+        '''
+        The 0th block column G[:,0], with spatial and spin indices separate
+        '''
+        if(self.Gcol is None):
+            n_loc_dof = self.n_loc_dof;
+            Bblocks = [np.zeros((len(group)*n_loc_dof, n_loc_dof), dtype = complex) for group in self.groups];
+            Bblocks[0][:n_loc_dof] = np.eye(n_loc_dof);
+            Xblocks = block_tridiag_back(self.gLs, self.Cups, self.Clows, Bblocks);
+            self.Gcol = self.unpack(Xblocks, is_diag = False);
+        return self.Gcol;
+
+    def Green_diag(self) -> np.ndarray:
+        '''
+        The diagonal blocks G[j,j], with spatial and spin indices separate,
+        by a backward sweep over the left connected greens functions
+        '''
+        if(self.Gdiag is None):
+            Gblocks = [None for _ in self.gLs];
+            Gblocks[-1] = self.gLs[-1];
+            for K in range(len(self.gLs)-2, -1, -1):
+                gL = self.gLs[K];
+                Gblocks[K] = gL + np.matmul(gL, np.matmul(self.Cups[K], np.matmul(Gblocks[K+1], np.matmul(self.Clows[K], gL))));
+            self.Gdiag = self.unpack(Gblocks, is_diag = True);
+        return self.Gdiag;
+
+    def unpack(self, blocks, is_diag) -> np.ndarray:
+        '''
+        Supersite blocks -> site blocks, for either a block column
+        (supersite K, any number of columns) or the diagonal
+        (supersite K, supersite K)
+        '''
+        n_loc_dof = self.n_loc_dof;
+        n_cols = n_loc_dof if is_diag else np.shape(blocks[0])[-1];
+        out = np.empty(np.shape(self.E)+(len(self.h), n_loc_dof, n_cols), dtype = complex);
+        for K in range(len(self.groups)):
+            for j in range(len(self.groups[K])):
+                rows = slice(j*n_loc_dof, (j+1)*n_loc_dof);
+                cols = slice(0, n_cols);
+                if(is_diag): cols = rows;
+                out[...,self.groups[K][j],:,:] = blocks[K][...,rows,cols];
+        return out;
+
+    def psi(self, Ajsigma) -> np.ndarray:
+        '''
+        psi_jsigma as in kernel, by back substitution with the incident
+        source itself as the right hand side, so that only O(N n_loc_dof)
+        is stored for each incident state rather than all of G[:,0]
+        '''
+        n_loc_dof = self.n_loc_dof;
+        Es = np.asarray(self.E)[..., None];
+        v_L = 2*self.tl*np.sin(np.arccos((Es-np.diagonal(self.h[0]))/(-2*self.tl)));
+        Acols = np.reshape(Ajsigma, (n_loc_dof, -1));
+        Bblocks = [np.zeros(np.shape(self.E)+(len(group)*n_loc_dof, np.shape(Acols)[-1]), dtype = complex) for group in self.groups];
+        Bblocks[0][...,:n_loc_dof,:] = Acols*v_L[...,:,None];
+        Xblocks = block_tridiag_back(self.gLs, self.Cups, self.Clows, Bblocks);
+        psi_jsigma = complex(0,1)*self.unpack(Xblocks, is_diag = False);
+        if(np.ndim(Ajsigma) == 1): return psi_jsigma[...,0];
+        return psi_jsigma;
+
+    def kernel(self, Ajsigma, is_psi_jsigma, is_Rhat):
+        '''
+        psi_jsigma, Rhat, or tuple of Rs, Ts, exactly as in kernel
+        '''
+        if(is_psi_jsigma): return self.psi(Ajsigma);
+        return Green_to_coefs(self.Green_col(), self.h, self.tl, self.E, Ajsigma, is_psi_jsigma, is_Rhat);
+
+    def ldos(self) -> np.ndarray:
+        '''
+        Local density of states -Im G[j,j]_{\sigma \sigma} / pi at every site j
+        and local dof sigma, array of shape (N+2, n_loc_dof). Unless the
+        diagonal blocks are already cached, they are got by the same backward
+        sweep as Green_diag, but only their diagonals are kept
+        '''
+        if(self.Gdiag is not None):
+            return -np.imag(np.diagonal(self.Gdiag, axis1=-2, axis2=-1))/np.pi;
+        n_loc_dof = self.n_loc_dof;
+        dos = np.empty(np.shape(self.E)+(len(self.h), n_loc_dof), dtype = float);
+        for K in range(len(self.gLs)-1, -1, -1):
+            gL = self.gLs[K];
+            if(K == len(self.gLs)-1): GKK = gL;
+            else: GKK = gL + np.matmul(gL, np.matmul(self.Cups[K], np.matmul(GKK, np.matmul(self.Clows[K], gL))));
+            diag = -np.imag(np.diagonal(GKK, axis1=-2, axis2=-1))/np.pi;
+            for j in range(len(self.groups[K])):
+                dos[...,self.groups[K][j],:] = diag[...,j*n_loc_dof:(j+1)*n_loc_dof];
+        return dos;
+
+    def bond_currents(self, Ajsigma) -> np.ndarray:
+        '''
+        Particle current of the scattering state psi_jsigma across each bond
+        (the cut between sites j and j+1), resolved by the local dof sigma of
+        the site it flows into. In units where the incident flux is
+        \sum_\sigma |A_j\sigma|^2 v_L\sigma, so that the total current across
+        the last bond is the incident flux times \sum_\sigma Ts
+
+        returns array of shape (N+1, n_loc_dof), with a new last axis running
+        over incident states when Ajsigma is 2d
+        '''
+        psi = self.psi(Ajsigma);
+        if(np.ndim(Ajsigma) == 2): # incident states to the front and back
+            return np.moveaxis(bond_currents(np.moveaxis(psi, -1, -3), self.tnn, self.tnnn), -3, -1);
+        return bond_currents(psi, self.tnn, self.tnnn);
+
+class ImpurityGreen():
+    def __init__(self, h, tnn, tnnn, tl, E, sites, rows = None, E_batch = 128, verbose = 0):
+        '''
+        Cache of the bare Greens function G0(E) of the system h, tnn, tnnn
+        restricted to the impurity sites, for sweeps (over J, Vq, Zeeman
+        terms, etc) that only change the on site blocks at those sites.
+        Each sweep point is then a Dyson (Woodbury) update
+        G = G0 + G0[:,S] dV (1 - G0[S,S] dV)^-1 G0[S,0]
+        costing O(k^3) in the impurity dimension k = len(sites)*n_loc_dof,
+        instead of a new solve of the whole system
+
+        Args
+        -h, tnn, tnnn, tl are as in kernel. h are the unperturbed on site blocks
+        -E, float or 1d array of floats, incident energies
+        -sites, list of ints, the sites whose on site blocks will be changed.
+            These must be in the scattering region, not the leads
+        Optional args
+        -rows, which rows j of G[j,0] to keep. The default, [0, N+1], is
+            enough for Rs, Ts, and Rhat. Pass all N+2 sites to get psi_jsigma
+        -E_batch, int, max number of energies in one stacked solve of G0
+        '''
+        N = len(h) - 2; # num scattering region sites
+        n_loc_dof = np.shape(h[0])[0];
+        if(not isinstance(sites, list)): raise TypeError;
+        if(len(set(sites)) != len(sites)): raise ValueError;
+        if(min(sites) < 1 or max(sites) > N): raise ValueError("impurity sites must be in the SR");
+        if(rows is None): rows = [0, N+1];
+        rows = list(rows);
+        if(rows[0] != 0 or rows[-1] != N+1): raise ValueError("rows must begin with LL and end with RL");
+
+        # bare green's function columns G0[:,0] and G0[:,S]
+        # keeping only the rows we need: rows and S
+        keep = np.array(rows+sites);
+        G0_kept = [];
+        for Ei in range(0, max(np.size(E),1), E_batch):
+            E_this = E;
+            if(np.ndim(E) == 1): E_this = E[Ei:Ei+E_batch];
+            G0_kept.append(Green_RGF(h, tnn, tnnn, tl, E_this, [0]+sites, verbose = verbose)[...,keep,:,:,:]);
+        if(np.ndim(E) == 1): G0_kept = np.concatenate(G0_kept);
+        else: G0_kept = G0_kept[0];
+
+        # reshape st the impurity sites and their local dofs are one index of size k
+        k = len(sites)*n_loc_dof;
+        G0_kept = np.swapaxes(G0_kept, -3, -2); # rows, loc dof, cols, loc dof
+        G0_kept = G0_kept.reshape(np.shape(E)+(len(keep)*n_loc_dof, (1+len(sites))*n_loc_dof));
+        nrows = len(rows)*n_loc_dof;
+        self.G0_col0 = G0_kept[...,:nrows,:n_loc_dof].reshape(np.shape(E)+(len(rows), n_loc_dof, n_loc_dof)); # G0[rows,0]
+        self.G0_rowsS = G0_kept[...,:nrows,n_loc_dof:].reshape(np.shape(E)+(len(rows), n_loc_dof, k)); # G0[rows,S]
+        self.G0_S0 = G0_kept[...,nrows:,:n_loc_dof]; # G0[S,0]
+        self.G0_SS = G0_kept[...,nrows:,n_loc_dof:]; # G0[S,S]
+        del G0_kept;
+
+        # what is needed to get the outputs of kernel
+        self.h_sites = np.copy(h[np.array(sites)]);
+        self.h_leads = np.array([h[0], h[-1]]);
+        self.tl = tl;
+        self.E = E;
+        self.sites = sites;
+        self.rows = rows;
+        self.N = N;
+
+    def Green(self, h_sites) -> np.ndarray:
+        '''
+        The 0th block column G[rows,0] of the perturbed system, where the
+        on site blocks at the impurity sites have been replaced by h_sites
+        '''
+        if(np.shape(h_sites) != np.shape(self.h_sites)): raise ValueError;
+
+        # perturbation is block diagonal in the impurity sites
+        n_loc_dof = np.shape(h_sites)[-1];
+        k = len(self.sites)*n_loc_dof;
+        dV = np.zeros((k, k), dtype = complex);
+        for sitei in range(len(self.sites)):
+            dV[sitei*n_loc_dof:(sitei+1)*n_loc_dof, sitei*n_loc_dof:(sitei+1)*n_loc_dof] = h_sites[sitei] - self.h_sites[sitei];
+
+        # Dyson equation, restricted to the impurity subspace
+        X = np.linalg.solve(np.eye(k) - np.matmul(self.G0_SS, dV), self.G0_S0); # (1 - G0 dV)^-1 G0 [S,0]
+        return self.G0_col0 + np.matmul(self.G0_rowsS, np.matmul(dV, X)[...,None,:,:]);
+
+    def kernel(self, h_sites, Ajsigma, is_psi_jsigma, is_Rhat):
+        '''
+        psi_jsigma, Rhat, or tuple of Rs, Ts as in kernel, for the
+        perturbed system where the on site blocks at the impurity sites
+        have been replaced by h_sites
+        '''
+        if(is_psi_jsigma and len(self.rows) != self.N+2): raise ValueError("construct with rows = all sites to get psi_jsigma");
+        return Green_to_coefs(self.Green(h_sites), self.h_leads, self.tl, self.E, Ajsigma, is_psi_jsigma, is_Rhat);
+
+##################################################################################
+#### adaptive energy grids
+
+def kernel_adaptive(h, tnn, tnnn, tl, Elims, Ajsigma, is_Rhat = False, tol = 1e-3, n_init = 33, max_depth = 16, is_log = False, verbose = 0, **kwargs) -> tuple:
+    '''
+    Rs, Ts (or Rhat) on a non-uniform energy grid, which is refined by
+    recursive bisection only where they change faster than tol, so that
+    sharp (Fano, Fabry-Perot) resonances are resolved without a dense grid
+    Args
+    -h, tnn, tnnn, tl, Ajsigma, is_Rhat are as in kernel
+    -Elims, tuple of floats, first and last energy of the grid
+    Optional args
+    -tol, float, an interval is bisected while the kernel output at its
+        midpoint differs by more than tol from linear interpolation
+        between its ends, or while its parent interval did
+    -n_init, int, number of energies in the initial uniform grid. Features
+        much narrower than its spacing can fall between midpoints and be missed
+    -max_depth, int, max number of times an initial interval is bisected
+    -is_log, whether to bisect (and make the initial grid) in log(E+2tl),
+        ie on a log scale measured from the bottom of the band, as in the
+        np.logspace grids of the run scripts
+    -kwargs are passed on to kernel
+
+    Returns
+    tuple of
+    -Es, sorted 1d array of the energies where kernel was evaluated
+    -outs, the kernel output at Es, stacked along a 0th energy axis
+    -interpolant, function of energy (float or array) that linearly
+        interpolates outs between the points of Es
+    '''
+    from scipy.interpolate import interp1d
+    if(n_init < 2): raise ValueError;
+
+    # energies are bisected in x, either E or log(E+2tl)
+    if(is_log):
+        to_x = lambda E: np.log(E+2*tl);
+        to_E = lambda x: np.exp(x)-2*tl;
+    else:
+        to_x = lambda E: E;
+        to_E = lambda x: x;
+
+    def evaluate(xs):
+        out = kernel(h, tnn, tnnn, tl, to_E(xs), Ajsigma, False, is_Rhat, verbose = verbose, **kwargs);
+        if(is_Rhat): out = (np.real(out), np.imag(out));
+        return np.concatenate([np.reshape(outi, (len(xs), -1)) for outi in out], axis = -1), out;
+
+    # initial uniform grid
+    xs = np.linspace(to_x(Elims[0]), to_x(Elims[-1]), n_init);
+    values, outs = evaluate(xs);
+    outs = [outs];
+    lefts = np.arange(n_init-1); # intervals as (left, right) indices into xs
+    rights = lefts + 1;
+    is_checked = np.zeros(len(lefts), dtype = bool); # whether parent was smooth
+
+    # refine by bisection, all the midpoints of one level in one (batched) call to kernel
+    for depth in range(max_depth):
+        if(len(lefts) == 0): break;
+        mids = (xs[lefts] + xs[rights])/2;
+        mid_values, mid_outs = evaluate(mids);
+        mid_indices = len(xs) + np.arange(len(mids));
+        xs = np.append(xs, mids);
+        values = np.append(values, mid_values, axis = 0);
+        outs.append(mid_outs);
+
+        # error of linear interpolation at the midpoints
+        errors = np.max(abs(mid_values - (values[lefts]+values[rights])/2), axis = -1);
+        # an interval is only accepted once it and its parent were both smooth,
+        # since a midpoint can land on the chord by accident
+        is_rough = errors > tol;
+        is_split = np.logical_or(is_rough, np.logical_not(is_checked));
+        if(verbose): print("depth = {:.0f}, {:.0f} new energies, {:.0f} still rough".format(depth, len(mids), np.sum(is_rough)));
+        lefts, rights = np.append(lefts[is_split], mid_indices[is_split]), np.append(mid_indices[is_split], rights[is_split]);
+        is_checked = np.tile(np.logical_not(is_rough[is_split]), 2);
+
+    # sort and assemble
+    order = np.argsort(xs);
+    Es = to_E(xs[order]);
+    if(is_Rhat):
+        outs = np.concatenate([out[0]+complex(0,1)*out[1] for out in outs])[order];
+        interpolant = interp1d(Es, outs, axis = 0);
+    else:
+        outs = tuple([np.concatenate([out[outi] for out in outs])[order] for outi in range(2)]);
+        interpolants = [interp1d(Es, outi, axis = 0) for outi in outs];
+        interpolant = lambda E: tuple([interp(E) for interp in interpolants]);
+    return Es, outs, interpolant;
+
+##################################################################################
+#### parameter sweeps
+
+def sweep(builder, grid, tl, E, Ajsigma, is_Rhat = False, n_workers = None, chunksize = None, blas_threads = 1, verbose = 0, **kwargs) -> np.ndarray:
+    '''
+    Rs, Ts (or Rhat) at every point of a grid of hamiltonian parameters,
+    fanned out over a pool of processes
+    Args
+    -builder, function which takes the grid parameters as keyword args and
+        returns the tuple h, tnn, tnnn (eg get_hblocks in run_wfm_gate.py).
+        Must be defined at the top level of a module, so that it pickles.
+        The processes are spawned, not forked, so a script which calls sweep
+        must do so under if __name__ == "__main__":
+    -grid, dict of parameter name : 1d array of values. Every combination
+        (the outer product) of the values is evaluated
+    -tl, E, Ajsigma, is_Rhat are as in kernel. E may be an array, in which
+        case all the energies are solved together at each grid point
+    Optional args
+    -n_workers, int, number of processes, defaults to the number of cpus
+    -chunksize, int, number of grid points sent to a process at once,
+        defaults to about 4 chunks per process
+    -blas_threads, int, number of BLAS threads each process may use. With
+        many processes, 1 avoids oversubscribing the cpus
+    -kwargs are passed on to kernel
+
+    Returns
+    structured array, with the shape of the grid (one axis per parameter, in
+    the order of grid), with one field per parameter plus fields "Rs" and "Ts"
+    (or "Rhat") holding the kernel output at that point
+    '''
+    import os
+    import itertools
+    import functools
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    if(not isinstance(grid, dict)): raise TypeError;
+
+    # every combination of parameters
+    names = list(grid.keys());
+    values = [np.asarray(grid[name]) for name in names];
+    shape = tuple([len(vals) for vals in values]);
+    points = [dict(zip(names, point)) for point in itertools.product(*values)];
+    if(n_workers is None): n_workers = os.cpu_count();
+    if(chunksize is None): chunksize = max(1, len(points)//(4*n_workers));
+    if(verbose): print("sweep over "+str(shape)+" = {:.0f} points, {:.0f} processes".format(len(points), n_workers));
+
+    # BLAS threads are read from the environment when numpy is imported by the
+    # new processes, so they are spawned (a forked process would inherit the BLAS
+    # already loaded here), and limited again in each if threadpoolctl is installed
+    blas_vars = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"];
+    old_env = {var : os.environ.get(var) for var in blas_vars};
+    for var in blas_vars: os.environ[var] = str(blas_threads);
+    try:
+        evaluate = functools.partial(sweep_point, builder, tl, E, Ajsigma, is_Rhat, kwargs);
+        with ProcessPoolExecutor(max_workers = n_workers, mp_context = multiprocessing.get_context("spawn"),
+                                 initializer = sweep_init, initargs = (blas_threads,)) as pool:
+            outs = list(pool.map(evaluate, points, chunksize = chunksize));
+    finally:
+        for var in blas_vars:
+            if(old_env[var] is None): os.environ.pop(var, None);
+            else: os.environ[var] = old_env[var];
+
+    # gather into one structured array
+    out_names = ["Rhat"] if is_Rhat else ["Rs", "Ts"];
+    dtype = [(name, vals.dtype) for name, vals in zip(names, values)];
+    dtype += [(out_name, np.asarray(out_val).dtype, np.shape(out_val)) for out_name, out_val in zip(out_names, outs[0])];
+    results = np.empty(len(points), dtype = dtype);
+    for name in names: results[name] = [point[name] for point in points];
+    for outi, out_name in enumerate(out_names): results[out_name] = [out[outi] for out in outs];
+    return results.reshape(shape);
+
+def sweep_init(blas_threads):
+    '''
+    Start up a sweep process, limiting its BLAS threads if threadpoolctl is
+    installed. Without it the limit is still set, by the environment variables
+    which the spawned process reads when it imports numpy
+    '''
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits = blas_threads);
+    except ImportError:
+        pass;
+
+def sweep_point(builder, tl, E, Ajsigma, is_Rhat, kwargs, params) -> tuple:
+    '''
+    Kernel output at one grid point of sweep, as a tuple
+    '''
+    h, tnn, tnnn = builder(**params);
+    out = kernel(h, tnn, tnnn, tl, E, Ajsigma, False, is_Rhat, **kwargs);
+    if(is_Rhat): return (out,);
+    return out;
+
+##################################################################################
+#### derivatives and gate optimization
+
+def kernel_derivs(h, tnn, tnnn, tl, E, Ajsigma, dblocks, is_Rhat, verbose = 0) -> tuple:
+    '''
+    Rs, Ts (or Rhat) and their analytic derivatives with respect to any
+    number of hamiltonian parameters, from dG = G dH G. Costs two Green's
+    function solves however many parameters there are
+    Args
+    -h, tnn, tnnn, tl, E, Ajsigma, is_Rhat are as in kernel
+    -dblocks, list of tuples (dh, dtnn, dtnnn), one for each parameter,
+        the derivatives of h, tnn, tnnn with respect to that parameter. The
+        lead blocks dh[0], dh[-1] must vanish, since they enter the self energies
+
+    Returns
+    tuple of Rs, Ts, dRs, dTs, where dRs, dTs have a new 0th axis running
+    over parameters
+    UNLESS is_Rhat = True, in which case tuple of Rhat, dRhat
+    '''
+    if(not isinstance(h, np.ndarray)): raise TypeError;
+    if(not isinstance(tnn, np.ndarray)): raise TypeError;
+    if(not isinstance(tnnn, np.ndarray)): raise TypeError;
+    for dh, _, _ in dblocks:
+        if(np.any(dh[0]) or np.any(dh[-1])): raise ValueError("lead blocks cannot depend on the parameters");
+
+    # G[:,0], and rows G[0,:], G[N+1,:] as columns of G^T, which is the
+    # greens function of the transposed blocks (see Hblock)
+    Gcol = Green_RGF(h, tnn, tnnn, tl, E, [0], verbose = verbose)[...,:,0,:,:];
+    transpose = lambda blocks: np.swapaxes(blocks, -2, -1);
+    Grows = Green_RGF(transpose(h), transpose(tnn), transpose(tnnn), tl, E, [0, len(h)-1], verbose = verbose);
+    Grows = transpose(np.moveaxis(Grows, -3, -4)); # rows, sites, then spin indices
+
+    # dG[row,0] = \sum_ij G[row,i] dH[i,j] G[j,0], for rows 0, N+1
+    dGs = [];
+    for dh, dtnn, dtnnn in dblocks:
+        dG = np.sum(np.matmul(Grows, np.matmul(dh, Gcol[...,None,:,:,:])), axis = -3);
+        for dt, hop in [(dtnn, 1), (dtnnn, 2)]:
+            if(not np.any(dt)): continue;
+            dG += np.sum(np.matmul(Grows[...,:-hop,:,:], np.matmul(dt, Gcol[...,None,hop:,:,:])), axis = -3); # upper diag
+            dG += np.sum(np.matmul(Grows[...,hop:,:,:], np.matmul(dt, Gcol[...,None,:-hop,:,:])), axis = -3); # lower diag
+        dGs.append(dG);
+    dGs = np.array(dGs); # parameters, *E, rows, then spin indices
+
+    # velocities as in Green_to_coefs
+    Es = np.asarray(E)[..., None];
+    ka_L = np.arccos((Es-np.diagonal(h[0]))/(-2*tl));
+    ka_R = np.arccos((Es-np.diagonal(h[-1]))/(-2*tl));
+    v_L = 2*tl*np.sin(ka_L);
+    v_R = 2*tl*np.sin(ka_R);
+
+    if(is_Rhat):
+        Rhat = Green_to_coefs(Gcol, h, tl, E, Ajsigma, False, True);
+        dRhat = 2*tl*complex(0,1)*dGs[...,0,:,:]*np.sin(ka_L)[...,None,:];
+        return Rhat, dRhat;
+
+    # Rs, Ts are |psi|^2 v / i_flux^2 at the first, last site
+    Rs, Ts = Green_to_coefs(Gcol, h, tl, E, Ajsigma, False, False);
+    Acols = np.reshape(Ajsigma, (len(Ajsigma), -1)); # incident states as columns
+    source = (Acols*v_L[...,:,None])[..., None, :, :];
+    psi_ends = complex(0,1)*np.matmul(Gcol[...,[0,-1],:,:], source);
+    dpsi_ends = complex(0,1)*np.matmul(dGs, source);
+    i_flux_sq = np.sum(Acols*Acols*np.real(v_L)[...,:,None], axis=-2)[..., None, :];
+    dRs = 2*np.real(np.conj(psi_ends[...,0,:,:]-Acols)*dpsi_ends[...,0,:,:])*np.real(v_L)[...,:,None]/i_flux_sq;
+    dTs = 2*np.real(np.conj(psi_ends[...,1,:,:])*dpsi_ends[...,1,:,:])*np.real(v_R)[...,:,None]/i_flux_sq;
+    if(np.ndim(Ajsigma) == 1): dRs, dTs = dRs[...,0], dTs[...,0];
+    return Rs, Ts, dRs, dTs;
+
+def optimize_gate(builder, params0, target, tl, E, fixed = {}, bounds = None, method = "L-BFGS-B", delta = 1e-4, verbose = 0, **kwargs) -> tuple:
+    '''
+    Find the continuous hamiltonian parameters for which Rhat best realizes
+    a target gate, by maximizing the gate fidelity (Molmer formula, as in
+    get_Fval in run_wfm_gate.py) with a scipy optimizer fed analytic
+    gradients from kernel_derivs
+    Args
+    -builder, function which takes the parameters as keyword args and
+        returns the tuple h, tnn, tnnn (eg get_hblocks in run_wfm_gate.py)
+    -params0, dict of parameter name : initial value, for the parameters
+        which are optimized
+    -target, n_loc_dof x n_loc_dof unitary, the target gate
+    -tl, float, hopping in leads
+    -E, float, energy of the incident electron
+    Optional args
+    -fixed, dict of parameter name : value, passed to builder but not
+        optimized (eg integer parameters like the number of barrier sites)
+    -bounds, list of (min, max) for each parameter in params0
+    -method, str, scipy.optimize.minimize method which uses gradients
+    -delta, float, step for getting the derivatives of the blocks from
+        builder by central differences (exact when the blocks are linear in
+        the parameter, as for J, Vq, VB)
+    -kwargs are passed on to scipy.optimize.minimize
+
+    Returns
+    tuple of dict of optimized parameter name : value, and the
+    scipy.optimize.OptimizeResult, whose fun is 1 - fidelity
+    '''
+    from scipy.optimize import minimize
+    names = list(params0.keys());
+    dim = len(target);
+
+    def blocks(x):
+        return builder(**fixed, **dict(zip(names, x)));
+
+    def infidelity(x):
+        h, tnn, tnnn = blocks(x);
+
+        # derivative blocks by central differences of the builder
+        dblocks = [];
+        for parami in range(len(names)):
+            step = np.zeros(len(names));
+            step[parami] = delta;
+            plus, minus = blocks(x+step), blocks(x-step);
+            dblocks.append(tuple([(plus[blocki]-minus[blocki])/(2*delta) for blocki in range(3)]));
+        Rhat, dRhat = kernel_derivs(h, tnn, tnnn, tl, E, np.zeros(dim), dblocks, True);
+
+        # fidelity F = sqrt( (Tr M M^\dagger + |Tr M|^2)/(d(d+1)) ), M = U^\dagger Rhat
+        M = np.matmul(np.conj(target.T), Rhat);
+        dM = np.matmul(np.conj(target.T), dRhat);
+        F = np.sqrt(np.real(np.trace(np.matmul(M, np.conj(M.T))) + abs(np.trace(M))**2)/(dim*(dim+1)));
+        dF = (np.real(np.einsum("ij,pij->p", np.conj(M), dM)) + np.real(np.conj(np.trace(M))*np.trace(dM, axis1=-2, axis2=-1)))/(F*dim*(dim+1));
+        if(verbose): print(dict(zip(names, x)), "F = {:.6f}".format(F));
+        return 1-F, -dF;
+
+    result = minimize(infidelity, np.array([params0[name] for name in names], dtype = float), jac = True, method = method, bounds = bounds, **kwargs);
+    return dict(zip(names, result.x)), result;
+
 ##################################################################################
 #### test code
 
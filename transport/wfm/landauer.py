@@ -0,0 +1,162 @@
+'''
+Christian Bunker
+M^2QM at UF
+October 2026
+
+Finite bias current from wfm transmission coefficients, in the Landauer
+formalism. e = hbar = 1, so for each outgoing channel sigma
+I_sigma(Vb, kBT) = \frac{1}{2\pi} \int dE T_sigma(E) [n_L(E) - n_R(E)]
+where n_L, n_R are Fermi-Dirac distributions at mu_L = mu_R + Vb and mu_R
+'''
+
+from transport import wfm
+
+import numpy as np
+
+##################################################################################
+#### Gauss-Kronrod rule
+
+# 15 point Kronrod nodes on [-1,1], and the weights of the Kronrod rule and of
+# the 7 point Gauss rule whose nodes are every other Kronrod node (as QUADPACK qk15)
+xgk = np.array([0.991455371120812639206854697526329, 0.949107912342758524526189684047851,
+                0.864864423359769072789712788640926, 0.741531185599394439863864773280788,
+                0.586087235467691130294144845693013, 0.405845151377397166906606412076961,
+                0.207784955007898467600689403773245, 0.000000000000000000000000000000000]);
+wgk = np.array([0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+                0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+                0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+                0.204432940075298892414161999234649, 0.209482141084727828012999174891714]);
+wg = np.array([0.129484966168869693270611432679082, 0.279705391489276667901467771423780,
+               0.381830050505118944950369775488975, 0.417959183673469387755102040816327]);
+GK_NODES = np.concatenate([-xgk, xgk[-2::-1]]);
+GK_WEIGHTS = np.concatenate([wgk, wgk[-2::-1]]);
+G_WEIGHTS = np.zeros(len(GK_NODES));
+G_WEIGHTS[1:8:2] = wg;
+G_WEIGHTS[9::2] = wg[-2::-1];
+del xgk, wgk, wg;
+
+##################################################################################
+#### memoized transmission
+
+class Tcache():
+    def __init__(self, h, tnn, tnnn, tl, Ajsigma, verbose = 0, **kwargs):
+        '''
+        Memoized Ts(E) of one scattering setup, so that energies which are
+        needed again (by another bias or temperature) are not solved again
+
+        Energies are keyed by their exact float values, so they are only
+        shared when the quadrature nodes coincide exactly. current builds its
+        nodes by bisecting the grid Emin + width*k, with width the smallest of
+        its kBTs, so calls with the same smallest kBT share energies, but calls
+        with a different smallest kBT (so a different grid) in general share
+        none. Pass all temperatures to one call of current to share them
+        Args
+        -h, tnn, tnnn, tl, Ajsigma are as in wfm.kernel
+        -kwargs are passed on to wfm.kernel
+        '''
+        self.h, self.tnn, self.tnnn, self.tl, self.Ajsigma = h, tnn, tnnn, tl, Ajsigma;
+        self.kwargs = kwargs;
+        self.verbose = verbose;
+        self.Ts = {};
+        self.n_solved = 0;
+
+    def __call__(self, Es) -> np.ndarray:
+        '''
+        Ts at every energy in the 1d array Es, shape (len(Es), n_loc_dof).
+        All energies not yet in the cache are solved in one call to wfm.kernel
+        '''
+        new_Es = np.unique([Eval for Eval in Es if Eval not in self.Ts]);
+        if(len(new_Es)):
+            _, new_Ts = wfm.kernel(self.h, self.tnn, self.tnnn, self.tl, new_Es, self.Ajsigma, False, False, **self.kwargs);
+            self.Ts.update(zip(new_Es, new_Ts));
+            self.n_solved += len(new_Es);
+            if(self.verbose > 1): print(" - solved {:.0f} new energies, {:.0f} in cache".format(len(new_Es), len(self.Ts)));
+        return np.array([self.Ts[Eval] for Eval in Es]);
+
+##################################################################################
+#### currents
+
+def fermi_window(E, muL, muR, kBT) -> np.ndarray:
+    '''
+    n_L(E) - n_R(E), the difference of Fermi-Dirac distributions,
+    computed without overflow for kBT << |E - mu|
+    '''
+    from scipy.special import expit
+    return expit((muL-E)/kBT) - expit((muR-E)/kBT);
+
+def current(h, tnn, tnnn, tl, Ajsigma, muR, Vbs, kBTs, n_kBT = 12, tol = 1e-10, max_depth = 20, cache = None, verbose = 0, **kwargs) -> np.ndarray:
+    '''
+    Landauer current at every bias and temperature, integrating the Fermi
+    window [mu_R, mu_L] +/- n_kBT kBT by adaptive Gauss-Kronrod quadrature
+    Args
+    -h, tnn, tnnn, tl, Ajsigma are as in wfm.kernel
+    -muR, float, chemical potential of the right lead, on the same scale as E
+        in wfm.kernel
+    -Vbs, 1d array, bias voltages, mu_L = mu_R + Vb
+    -kBTs, 1d array, temperatures, must be > 0
+    Optional args
+    -n_kBT, float, how many kBT beyond the bias window to integrate
+    -tol, float, absolute error tolerance of each panel of the quadrature
+    -max_depth, int, max number of times a panel is bisected
+    -cache, Tcache for this setup, to share energies with earlier calls
+    -kwargs are passed on to wfm.kernel
+
+    Panels are got by bisecting a fixed grid of energies, whose spacing is the
+    smallest kBT, so that the quadrature nodes of different biases and
+    temperatures coincide and Ts at each node is only solved once
+
+    Energies are limited to the band of the LL channels which are incident in
+    Ajsigma, so there is no current from energies where they are closed
+
+    Returns
+    array of shape (len(Vbs), len(kBTs), n_loc_dof), current into each outgoing
+    channel sigma of the state incident in Ajsigma
+    '''
+    Vbs, kBTs = np.atleast_1d(Vbs), np.atleast_1d(kBTs);
+    if(np.any(kBTs <= 0)): raise ValueError("kBT must be > 0");
+    if(cache is None): cache = Tcache(h, tnn, tnnn, tl, Ajsigma, verbose = verbose, **kwargs);
+    n_loc_dof = np.shape(h[0])[0];
+
+    # only energies where the incident channels of the LL are open contribute
+    # (wfm.kernel is not defined where they are closed)
+    is_incident = np.any(np.reshape(Ajsigma, (n_loc_dof, -1)) != 0, axis = -1);
+    Emin = np.max(np.real(np.diagonal(h[0]))[is_incident]) - 2*abs(tl);
+    Emax = np.min(np.real(np.diagonal(h[0]))[is_incident]) + 2*abs(tl);
+    width = np.min(kBTs); # of panels on the base grid
+
+    currents = np.zeros((len(Vbs), len(kBTs), n_loc_dof));
+    for Vbi, Vb in enumerate(Vbs):
+        muL = muR + Vb;
+        for kBTi, kBT in enumerate(kBTs):
+            lo = max(Emin, min(muL, muR) - n_kBT*kBT);
+            hi = min(Emax, max(muL, muR) + n_kBT*kBT);
+            if(lo >= hi): continue;
+
+            # panels on the base grid which cover [lo, hi]
+            edges = Emin + width*np.arange(np.floor((lo-Emin)/width), np.ceil((hi-Emin)/width)+1);
+            edges = np.clip(edges, Emin, Emax);
+            lefts, rights = edges[:-1], edges[1:];
+
+            # bisect panels until Gauss and Kronrod estimates agree
+            for depth in range(max_depth+1):
+                centers, halves = (lefts+rights)/2, (rights-lefts)/2;
+                Es = (centers[:,None] + halves[:,None]*GK_NODES).flatten();
+                integrand = cache(Es)*fermi_window(Es, muL, muR, kBT)[:,None];
+                integrand = integrand.reshape(len(lefts), len(GK_NODES), n_loc_dof);
+                kronrod = halves[:,None]*np.einsum("k,pks->ps", GK_WEIGHTS, integrand);
+                gauss = halves[:,None]*np.einsum("k,pks->ps", G_WEIGHTS, integrand);
+                is_rough = np.max(abs(kronrod - gauss), axis = -1) > tol;
+                if(depth == max_depth): is_rough[:] = False;
+                currents[Vbi, kBTi] += np.sum(kronrod[~is_rough], axis = 0)/(2*np.pi);
+                if(not np.any(is_rough)): break;
+                lefts, rights = np.append(lefts[is_rough], centers[is_rough]), np.append(centers[is_rough], rights[is_rough]);
+
+    if(verbose): print("current: {:.0f} energies solved".format(cache.n_solved));
+    return currents;
+
+##################################################################################
+#### test code
+
+if __name__ == "__main__":
+
+    pass;